@@ -0,0 +1,206 @@
+"""
+Emit events on TrueNAS service, jail and alert state transitions.
+
+Instead of polling, this keeps a single subscription to the middleware
+collection events open and only reports transitions that have been stable
+for ``debounce`` seconds. Flapping back to the previous state before that
+does not emit anything.
+
+.. code-block:: yaml
+
+    beacons:
+      truenas:
+        - collections:
+            - service.query
+            - jail.query
+            - alert.list
+        - debounce: 5
+
+Events are tagged ``salt/beacon/<minion_id>/truenas/<collection>/<id>``
+and contain ``collection``, ``id``, ``old`` and ``new``. For alerts,
+the state is the alert level while present and ``null`` after it was cleared.
+"""
+import collections
+import logging
+import time
+
+import salt.utils.beacons
+import salt.utils.path
+import truenasutils as tn
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas"
+
+CKEY = "truenas.beacon"
+
+# collection: (query, identifying field, state field)
+COLLECTIONS = {
+    "alert.list": ("alert.list", "uuid", "level"),
+    "jail.query": ("jail.query", "id", "state"),
+    "service.query": ("service.query", "service", "state"),
+}
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def validate(config):
+    """
+    Validate the beacon configuration.
+    """
+    if not isinstance(config, list):
+        return False, "Configuration for truenas beacon must be a list"
+    config = salt.utils.beacons.list_to_dict(config)
+    unknown = set(config.get("collections", [])).difference(COLLECTIONS)
+    if unknown:
+        return (
+            False,
+            f"Unknown collections: {', '.join(sorted(unknown))}. "
+            f"Valid: {', '.join(COLLECTIONS)}",
+        )
+    try:
+        float(config.get("debounce", 5))
+    except (TypeError, ValueError):
+        return False, "`debounce` must be a number"
+    return True, "Valid beacon configuration"
+
+
+def beacon(config):
+    """
+    Report stable state transitions received since the last run.
+    """
+    config = salt.utils.beacons.list_to_dict(config)
+    watched = config.get("collections") or list(COLLECTIONS)
+    debounce = float(config.get("debounce", 5))
+
+    sub = __context__.get(CKEY)
+    if sub is not None and not sub.alive():
+        log.warning("Lost connection to TrueNAS middleware, resubscribing")
+        old_states = sub.states
+        sub.close()
+        sub = None
+    else:
+        old_states = None
+    if sub is None:
+        try:
+            sub = _Subscription(watched)
+        except Exception as err:  # pylint: disable=broad-except
+            log.error(f"Failed subscribing to TrueNAS middleware events: {err}")
+            return []
+        __context__[CKEY] = sub
+        if old_states is not None:
+            # Report what changed while we were disconnected
+            sub.diff_baseline(old_states)
+    return sub.poll(debounce)
+
+
+def close(config):  # pylint: disable=unused-argument
+    """
+    Close the subscription when the beacon is removed.
+    """
+    sub = __context__.pop(CKEY, None)
+    if sub is not None:
+        sub.close()
+
+
+class _Subscription:
+    def __init__(self, watched):
+        self.watched = watched
+        # Appending and popping are thread-safe, callbacks run in the client thread
+        self.queue = collections.deque()
+        self.pending = {}
+        self.states = {}
+        # Subscriptions need a live connection, not a snapshot or mirror
+        self.client = tn.get_local_client(__opts__, __context__)
+        try:
+            for coll in watched:
+                self.client.subscribe(coll, self._callback(coll))
+            self.states = self._baseline()
+        except Exception:
+            self.client.close()
+            raise
+
+    def _callback(self, coll):
+        def callback(mtype, **message):  # pylint: disable=unused-argument
+            self.queue.append((coll, message))
+
+        return callback
+
+    def _baseline(self):
+        states = {}
+        for coll in self.watched:
+            query, key, state = COLLECTIONS[coll]
+            res = self.client.call(query)
+            states[coll] = {item[key]: item.get(state) for item in res}
+        return states
+
+    def alive(self):
+        try:
+            self.client.call("core.ping", timeout=10)
+        except Exception:  # pylint: disable=broad-except
+            return False
+        return True
+
+    def diff_baseline(self, old_states):
+        now = time.time()
+        for coll, items in self.states.items():
+            old = old_states.get(coll, {})
+            for ident in set(items).union(old):
+                if items.get(ident) != old.get(ident):
+                    self.pending[(coll, ident)] = (items.get(ident), now)
+            self.states[coll] = dict(old)
+
+    def poll(self, debounce):
+        now = time.time()
+        while self.queue:
+            coll, message = self.queue.popleft()
+            ident, new = self._parse(coll, message)
+            if ident is None:
+                continue
+            if new == self.states[coll].get(ident):
+                self.pending.pop((coll, ident), None)
+                continue
+            prev = self.pending.get((coll, ident))
+            if prev is None or prev[0] != new:
+                self.pending[(coll, ident)] = (new, now)
+
+        events = []
+        for (coll, ident), (new, since) in list(self.pending.items()):
+            if now - since < debounce:
+                continue
+            self.pending.pop((coll, ident))
+            old = self.states[coll].get(ident)
+            if new is None:
+                self.states[coll].pop(ident, None)
+            else:
+                self.states[coll][ident] = new
+            events.append(
+                {
+                    "tag": f"{coll}/{ident}",
+                    "collection": coll,
+                    "id": ident,
+                    "old": old,
+                    "new": new,
+                }
+            )
+        return events
+
+    def _parse(self, coll, message):
+        _, key, state = COLLECTIONS[coll]
+        fields = message.get("fields") or {}
+        ident = fields.get(key, message.get("id"))
+        if message.get("msg", "").lower() == "removed":
+            return ident, None
+        if state not in fields:
+            return None, None
+        return ident, fields[state]
+
+    def close(self):
+        try:
+            self.client.close()
+        except Exception:  # pylint: disable=broad-except
+            pass
@@ -1,15 +1,22 @@
 """
 General functions for TrueNAS integration.
 """
+import hashlib
+import json
 import logging
+import os
+import time
 
 import salt.utils.path
 import truenasutils as tn
+from salt.exceptions import CommandExecutionError
 
 log = logging.getLogger(__name__)
 
 __virtualname__ = "truenas"
 
+FACTS_CKEY = "truenas.facts"
+
 
 def __virtual__():
     if salt.utils.path.which("midclt"):
@@ -51,3 +58,301 @@ def job(func, *args):
     """
     with tn.get_client(__opts__, __context__) as client:
         return client.job(func, *args)
+
+
+def bulk(func, params, batch_size=None):
+    """
+    Execute a TrueNAS middleware call for many argument lists
+    as a single ``core.bulk`` job.
+    Returns a list of dicts with ``result`` and ``error`` per item.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.bulk certificate.delete '[[42], [43], [44]]'
+
+    func
+        The API method to call for each item.
+
+    params
+        A list of argument lists. Items that are not lists are passed
+        as the single argument.
+
+    batch_size
+        Split ``params`` into several ``core.bulk`` jobs of this size.
+        By default, all items are sent in a single job. Batches run
+        one after another.
+    """
+
+    def progress(job):
+        prog = job.get("progress") or {}
+        log.info(
+            f"core.bulk {func}: {prog.get('percent')}% {prog.get('description') or ''}"
+        )
+
+    with tn.get_client(__opts__, __context__) as client:
+        return client.bulk(func, params, batch_size=batch_size, callback=progress)
+
+
+def snapshot(calls=None):
+    """
+    Dump services, service configurations, certificates (metadata and
+    fingerprints only), jails and init/shutdown scripts into a versioned
+    local cache file in one pass over a single connection.
+
+    When ``truenas_snapshot_reads`` is set in the minion configuration,
+    execution modules answer ``*.config`` and ``*.query`` reads from this
+    snapshot instead of making live calls. Set it to ``test`` to only do
+    so during test runs, which is recommended. After the configuration
+    database changed, outdated results are read again individually when
+    they are requested. If changes cannot be detected, live calls are used.
+    Results with runtime state (services, jails) or stripped secrets
+    (certificates, SSH host keys) are always read live.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.snapshot
+
+    calls
+        Override the list of read calls to include in the snapshot.
+    """
+    if calls is None:
+        calls = [
+            "service.query",
+            "certificate.query",
+            "jail.query",
+            "initshutdownscript.query",
+        ] + [f"{ns}.config" for ns in __salt__["truenas_service.list_namespaces"]()]
+    # Always take the snapshot from live data
+    with tn.get_local_client(__opts__, __context__) as client:
+        snap = tn.take_snapshot(client, calls)
+    path = tn.save_snapshot(__opts__, snap)
+    __context__[tn.SNAPSHOT_CKEY] = snap
+    for func, err in snap["errors"].items():
+        log.warning(f"Could not include {func} in the snapshot: {err}")
+    return {
+        "path": path,
+        "version": snap["version"],
+        "created": snap["created"],
+        "calls": sorted(snap["data"]),
+        "errors": snap["errors"],
+    }
+
+
+def validate(func, *args):
+    """
+    Validate parameters for an API method locally against its schema,
+    before incurring any network or job cost. Raises an error describing
+    all invalid parameters.
+
+    The schemas (``core.get_methods``) are fetched once per TrueNAS
+    version (``truenas_version_str`` grain) and cached on disk.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.validate ssh.update '{"tcpport": "22"}'
+
+    func
+        The API method to validate the parameters for.
+    """
+    methods = tn.get_methods(
+        __opts__, __context__, version=__grains__.get("truenas_version_str")
+    )
+    return tn.validate_payload(methods, func, args)
+
+
+def limiter_stats():
+    """
+    Return statistics about time spent waiting for the host-wide limit
+    on concurrent middleware calls (``truenas_max_concurrent_calls``).
+
+    ``host`` covers all processes since the statistics were first written,
+    ``process`` only calls made by this process.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.limiter_stats
+    """
+    limiter = tn.get_limiter(__opts__, __context__)
+    if limiter is None:
+        return {"enabled": False}
+    return {
+        "enabled": True,
+        "limit": limiter.limit,
+        "host": tn.load_limiter_stats(limiter.path),
+        "process": dict(limiter.stats),
+    }
+
+
+def facts(jails=None, paths=None, jail_paths=None):
+    """
+    Return facts needed while rendering states in a single call:
+    the activated iocage pool, the root path, JID and state of jails
+    and whether local paths exist (and their mtime).
+
+    Templates should request everything they need in one call. With
+    salt-ssh, each call during rendering is a separate remote execution.
+    Otherwise, middleware lookups are memoized in ``__context__``
+    for the rest of the process. Path information is always current.
+    The middleware is only queried when jails are requested, otherwise
+    ``iocage_pool`` is ``None``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.facts jails='[minio]' paths='[/root/certs/nas.key]'
+        salt-ssh '*' truenas.facts jail_paths='{minio: [usr/local/etc/minio/certs/private.key]}'
+
+    jails
+        A list of jail names (``id`` field) to include. Jails that
+        do not exist are omitted.
+
+    paths
+        A list of local paths to include.
+
+    jail_paths
+        A mapping of jail names to lists of paths relative to the jail root.
+        These jails are included as well, with their paths listed under
+        ``paths`` in the jail entry.
+    """
+    cached = __context__.setdefault(FACTS_CKEY, {"jails": {}})
+    jail_paths = jail_paths or {}
+    jails = [str(x) for x in (jails or [])]
+    jails.extend(str(x) for x in jail_paths if str(x) not in jails)
+    missing = [jail for jail in jails if jail not in cached["jails"]]
+    # Paths alone do not need the middleware
+    if jails and ("iocage_pool" not in cached or missing):
+        with tn.get_client(__opts__, __context__) as client:
+            if "iocage_pool" not in cached:
+                try:
+                    cached["iocage_pool"] = client.call("jail.get_activated_pool")
+                except Exception as err:  # pylint: disable=broad-except
+                    # There are no jails on SCALE
+                    log.debug(f"Could not get the activated iocage pool: {err}")
+                    cached["iocage_pool"] = None
+            if missing:
+                res = client.call(
+                    "jail.query",
+                    [["id", "in", missing]],
+                    {"select": ["id", "jid", "state"], "limit": 0},
+                )
+                found = {jail["id"]: jail for jail in res}
+                for name in missing:
+                    cached["jails"][name] = found.get(name)
+    pool = cached.get("iocage_pool")
+    ret = {"iocage_pool": pool, "jails": {}, "paths": {}}
+    for name in jails:
+        jail = cached["jails"][name]
+        if jail is None:
+            continue
+        root = f"/mnt/{pool}/iocage/jails/{name}/root" if pool else None
+        ret["jails"][name] = {
+            "root": root,
+            "jid": jail.get("jid"),
+            "state": jail.get("state"),
+        }
+        if name in jail_paths:
+            ret["jails"][name]["paths"] = {
+                path: _path_facts(os.path.join(root, path) if root else None)
+                for path in jail_paths[name]
+            }
+    for path in paths or []:
+        ret["paths"][path] = _path_facts(path)
+    return ret
+
+
+def _path_facts(path):
+    try:
+        mtime = os.stat(path).st_mtime
+    except (OSError, TypeError):
+        return {"exists": False, "mtime": None}
+    return {"exists": True, "mtime": mtime}
+
+
+def tree_hash(path):
+    """
+    Return a SHA-256 hash over the names, modes and contents
+    of all files and symlinks below a directory.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.tree_hash /mnt/tank/telegraf/pkg
+
+    path
+        The directory to hash.
+    """
+    if not os.path.isdir(path):
+        raise CommandExecutionError(f"Not a directory: {path}")
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            rel = os.path.relpath(full, path)
+            stat = os.lstat(full)
+            digest.update(f"{rel}\0{stat.st_mode:o}\0".encode())
+            if os.path.islink(full):
+                digest.update(os.readlink(full).encode())
+                continue
+            with open(full, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_matches(path, manifest):
+    """
+    Check whether a directory still matches the tree hash
+    stored in a manifest by ``truenas.write_manifest``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.manifest_matches /mnt/tank/telegraf/pkg /mnt/tank/artifacts/manifests/a0748d.json
+
+    path
+        The directory to check.
+
+    manifest
+        The path of the manifest file.
+    """
+    try:
+        with open(manifest) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if stored.get("path") != path or not os.path.isdir(path):
+        return False
+    return stored.get("hash") == tree_hash(path)
+
+
+def write_manifest(path, manifest):
+    """
+    Store the tree hash of a directory in a manifest file.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas.write_manifest /mnt/tank/telegraf/pkg /mnt/tank/artifacts/manifests/a0748d.json
+
+    path
+        The directory to hash.
+
+    manifest
+        The path of the manifest file.
+    """
+    data = {"path": path, "hash": tree_hash(path), "created": time.time()}
+    tn.write_cache(manifest, data)
+    return data
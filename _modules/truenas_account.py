@@ -0,0 +1,186 @@
+"""
+Operate on TrueNAS users and groups.
+"""
+import logging
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_account"
+
+IKEY = "truenas_account.user_index"
+
+# account type: (API namespace, identifying field)
+ACCOUNT_TYPES = {
+    "group": ("group", "group"),
+    "user": ("user", "username"),
+}
+
+INDEX_FIELDS = ["id", "uid", "username", "home", "shell", "group", "groups", "locked"]
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def list_users(select=None, usernames=None):
+    """
+    List (all) users with a single query.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_account.list_users select='[id, username, uid]'
+
+    select
+        A list of fields to return. Defaults to all.
+
+    usernames
+        Only list these users.
+    """
+    return _query("user", select=select, names=usernames)
+
+
+def list_groups(select=None, names=None):
+    """
+    List (all) groups with a single query.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_account.list_groups select='[id, group, gid]'
+
+    select
+        A list of fields to return. Defaults to all.
+
+    names
+        Only list these groups.
+    """
+    return _query("group", select=select, names=names)
+
+
+def user_index(refresh=False):
+    """
+    Return a mapping of usernames to their ``uid``, ``home``, ``shell``,
+    primary group name (``group``) and whether they are ``locked``.
+
+    All users are fetched with a single projected query the first time
+    this is called during a run, later calls return the cached index.
+    Meant for templates that need account information for many users.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_account.user_index
+
+    refresh
+        Query the users again even if they are cached. Defaults to false.
+    """
+    if refresh or IKEY not in __context__:
+        index = {}
+        for user in list_users(select=INDEX_FIELDS):
+            group = user.get("group") or {}
+            index[user["username"]] = {
+                "uid": user.get("uid"),
+                "home": user.get("home"),
+                "shell": user.get("shell"),
+                "group": group.get("bsdgrp_group"),
+                "locked": user.get("locked"),
+            }
+        __context__[IKEY] = index
+    return __context__[IKEY]
+
+
+def apply(typ, create=None, update=None, delete=None, batch_size=None):
+    """
+    Create, update and delete many users or groups. Each kind of change
+    is sent as a single ``core.bulk`` job.
+
+    Returns a dict with ``created``, ``updated`` and ``deleted``
+    (lists of names/IDs) and ``errors`` (mapping of names/IDs to
+    error messages).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_account.apply group create='[{"name": "media"}]'
+
+    typ
+        The account type, either ``user`` or ``group``.
+
+    create
+        A list of ``user.create``/``group.create`` parameters.
+
+    update
+        A mapping of IDs to the parameters to update.
+
+    delete
+        A list of IDs to delete.
+
+    batch_size
+        Split each kind of change into ``core.bulk`` jobs of this size.
+        Defaults to a single job.
+    """
+    ns, field = _ns(typ)
+    create = create or []
+    update = {int(ident): payload for ident, payload in (update or {}).items()}
+    delete = [int(ident) for ident in delete or []]
+    # Group parameters are called `name`, but queries return `group`
+    create_field = "name" if typ == "group" else field
+    for payload in create:
+        __salt__["truenas.validate"](f"{ns}.create", payload)
+    for ident, payload in update.items():
+        __salt__["truenas.validate"](f"{ns}.update", ident, payload)
+    ret = {"created": [], "updated": [], "deleted": [], "errors": {}}
+    changes = (
+        ("create", [p.get(create_field) for p in create], create),
+        ("update", list(update), [[i, p] for i, p in update.items()]),
+        ("delete", delete, [[i] for i in delete]),
+    )
+    with tn.get_client(__opts__, __context__) as client:
+        for action, idents, params in changes:
+            if not params:
+                continue
+            res = client.bulk(f"{ns}.{action}", params, batch_size=batch_size)
+            for ident, status in zip(idents, res):
+                if status["error"]:
+                    ret["errors"][ident] = f"Failed to {action}: {status['error']}"
+                else:
+                    ret[f"{action}d"].append(ident)
+    if typ == "user" and (ret["created"] or ret["updated"] or ret["deleted"]):
+        __context__.pop(IKEY, None)
+    return ret
+
+
+def _query(typ, select=None, names=None):
+    ns, field = _ns(typ)
+    filters = []
+    if names is not None:
+        if not isinstance(names, list):
+            names = [names]
+        filters.append([field, "in", [str(x) for x in names]])
+    # ensure we don't get paged results
+    options = {"limit": 0, "order_by": [field]}
+    if select:
+        if not isinstance(select, list):
+            select = [select]
+        options["select"] = [str(x) for x in select]
+    with tn.get_client(__opts__, __context__) as client:
+        return client.call(f"{ns}.query", filters, options)
+
+
+def _ns(typ):
+    if typ not in ACCOUNT_TYPES:
+        raise SaltInvocationError(
+            f"Invalid account type '{typ}'. Valid: {', '.join(ACCOUNT_TYPES)}"
+        )
+    return ACCOUNT_TYPES[typ]
@@ -1,7 +1,9 @@
 """
 Operate on the TrueNAS certificate store.
 """
+import json
 import logging
+import os
 
 import salt.utils.path
 import truenasutils as tn
@@ -9,6 +11,8 @@ from salt.exceptions import CommandExecutionError
 
 log = logging.getLogger(__name__)
 
+FKEY = "truenas_cert.fingerprints"
+
 __virtualname__ = "truenas_cert"
 __func_alias__ = {
     "import_": "import",
@@ -22,7 +26,7 @@ def __virtual__():
     return False, "Does not seem to be TrueNAS"
 
 
-def list_(name_prefix=None, order_by="name", include_private_key=False):
+def list_(name_prefix=None, order_by="name", include_private_key=False, select=None):
     """
     List (all) present certificates and their keys.
 
@@ -41,10 +45,18 @@ def list_(name_prefix=None, order_by="name", include_private_key=False):
 
     include_private_key
         Include the private key contents. Defaults to false.
+
+    select
+        A list of fields to return, e.g. ``[id, name]``.
+        By default, all fields are returned.
     """
     filters = []
     # ensure we don't get paged results
     options = {"limit": 0}
+    if select:
+        if not isinstance(select, list):
+            select = [select]
+        options["select"] = [str(x) for x in select]
     if name_prefix:
         filters.append(["name", "~", name_prefix])
     if order_by:
@@ -60,6 +72,72 @@ def list_(name_prefix=None, order_by="name", include_private_key=False):
     return res
 
 
+def fingerprints(name_prefix=None):
+    """
+    Return the SHA-256 fingerprints of (all) present certificates,
+    keyed by name.
+
+    Imported certificates cannot change, so fingerprints are kept in a
+    local index. Only names and IDs are queried, certificate contents
+    are only fetched for certificates missing from the index.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_cert.fingerprints my-cert
+
+    name_prefix
+        Filter certificates by name prefix.
+    """
+    present = list_(name_prefix, order_by="name", select=["id", "name"])
+    index = _load_fingerprint_index()
+    missing = [cert["id"] for cert in present if _fp_key(cert) not in index]
+    if missing:
+        with tn.get_client(__opts__, __context__) as client:
+            res = client.call(
+                "certificate.query",
+                [["id", "in", missing]],
+                {"limit": 0, "select": ["id", "name", "certificate"]},
+            )
+        for cert in res:
+            if cert.get("certificate"):
+                index[_fp_key(cert)] = tn.pem_fingerprint(cert["certificate"])
+        if name_prefix is None:
+            # Forget deleted certificates
+            current = {_fp_key(cert) for cert in present}
+            index = {key: fp for key, fp in index.items() if key in current}
+        _save_fingerprint_index(index)
+    return {
+        cert["name"]: index[_fp_key(cert)] for cert in present if _fp_key(cert) in index
+    }
+
+
+def fingerprint(certificate, append_certs=None):
+    """
+    Return the SHA-256 fingerprint of a certificate (chain)
+    as used by ``truenas_cert.fingerprints``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_cert.fingerprint /opt/ssl/my-cert.crt
+
+    certificate
+        The certificate.
+        Parameter for ``x509.encode_certificate`` (in short: path or contents).
+
+    append_certs
+        A list of certificates to append (certificate chain).
+        Parameter for ``x509.encode_certificate`` (in short: list of paths or contents).
+    """
+    pem = __salt__["x509.encode_certificate"](
+        certificate, append_certs=append_certs, encoding="pem"
+    )
+    return tn.pem_fingerprint(pem)
+
+
 def import_(name, certificate, private_key, append_certs=None):
     """
     Import a certificate.
@@ -95,6 +173,10 @@ def import_(name, certificate, private_key, append_certs=None):
         "certificate": certificate,
         "privatekey": private_key,
     }
+    # Validation errors can contain the values, do not include the key
+    __salt__["truenas.validate"](
+        "certificate.create", dict(payload, privatekey="<redacted>")
+    )
     with tn.get_client(__opts__, __context__) as client:
         return client.job("certificate.create", payload)
 
@@ -135,7 +217,38 @@ def clean(name_prefix=None):
     for cert in certs:
         if __salt__["x509.expires"](cert["certificate"]):
             remove.append(cert["id"])
+    if not remove:
+        return remove
     with tn.get_client(__opts__, __context__) as client:
-        for rm in remove:
-            client.job("certificate.delete", rm)
+        res = client.bulk("certificate.delete", remove)
+    failed = {rm: status["error"] for rm, status in zip(remove, res) if status["error"]}
+    if failed:
+        raise CommandExecutionError(
+            "Failed removing some certificates: "
+            + ", ".join(f"{rm}: {err}" for rm, err in failed.items())
+        )
     return remove
+
+
+def _fp_key(cert):
+    # IDs can be reused after deletion, names are timestamped
+    return f"{cert['id']}:{cert['name']}"
+
+
+def _fingerprint_index_path():
+    return os.path.join(__opts__["cachedir"], "truenas", "cert_fingerprints.json")
+
+
+def _load_fingerprint_index():
+    if FKEY not in __context__:
+        try:
+            with open(_fingerprint_index_path()) as f:
+                __context__[FKEY] = json.load(f)
+        except (OSError, ValueError):
+            __context__[FKEY] = {}
+    return dict(__context__[FKEY])
+
+
+def _save_fingerprint_index(index):
+    __context__[FKEY] = index
+    tn.write_cache(_fingerprint_index_path(), index)
@@ -0,0 +1,277 @@
+"""
+Inspect TrueNAS datasets.
+"""
+import logging
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_dataset"
+__func_alias__ = {
+    "list_": "list",
+}
+
+PROPERTY_FIELDS = ("value", "rawvalue", "parsed", "source")
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def query(
+    filters=None,
+    properties=None,
+    select=None,
+    order_by="name",
+    flat=True,
+    retrieve_children=None,
+    user_properties=False,
+    compact=True,
+    prop_field="value",
+):
+    """
+    Query datasets with server-side filtering and projection.
+
+    By default, only the requested properties are retrieved and each property
+    dict is reduced to a single value, which keeps results small even for
+    pools with thousands of datasets.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.query '[["pool", "=", "tank"]]' properties='[compression, quota]'
+
+    filters
+        A list of query filters, e.g. ``[["pool", "=", "tank"]]``.
+        Evaluated by the middleware.
+
+    properties
+        A list of ZFS properties to retrieve, e.g. ``[compression, quota]``.
+        If unset, all properties are retrieved.
+
+    select
+        A list of fields to return. Defaults to ``id``, ``name``, ``type``
+        and the requested ``properties`` if these were specified,
+        otherwise all fields are returned.
+
+    order_by
+        Order returned list by this named value.
+        Defaults to ``name``.
+
+    flat
+        Return a flat list instead of nesting child datasets.
+        Defaults to true.
+
+    retrieve_children
+        Retrieve children of matched datasets. The middleware only uses
+        the filters to select the initial datasets for a single
+        ``["id", "=", <name>]`` filter, otherwise it starts from the pool
+        roots and needs to retrieve their children. Defaults to false for
+        a single ID filter, true otherwise.
+
+    user_properties
+        Include user properties. Defaults to false.
+
+    compact
+        Reduce ZFS property dicts to the value in ``prop_field``.
+        Defaults to true.
+
+    prop_field
+        When ``compact`` is true, the field of ZFS property dicts to return.
+        Either ``value``, ``rawvalue``, ``parsed`` or ``source``.
+        Defaults to ``value``.
+    """
+    if prop_field not in PROPERTY_FIELDS:
+        raise SaltInvocationError(
+            f"Invalid prop_field '{prop_field}'. Valid: {', '.join(PROPERTY_FIELDS)}"
+        )
+    filters = filters or []
+    if retrieve_children is None:
+        retrieve_children = not _is_id_filter(filters)
+    extra = {
+        "flat": flat,
+        "retrieve_children": retrieve_children,
+        "user_properties": user_properties,
+    }
+    if properties is not None:
+        if not isinstance(properties, list):
+            properties = [properties]
+        extra["properties"] = [str(x) for x in properties]
+        if select is None:
+            select = ["id", "name", "type"] + extra["properties"]
+    # ensure we don't get paged results
+    options = {"limit": 0, "extra": extra}
+    if select:
+        if not isinstance(select, list):
+            select = [select]
+        options["select"] = [str(x) for x in select]
+    if order_by:
+        if not isinstance(order_by, list):
+            order_by = [order_by]
+        options["order_by"] = [str(x) for x in order_by]
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.call("pool.dataset.query", filters, options)
+    if compact:
+        res = [tn.compact_properties(ds, field=prop_field) for ds in res]
+    return res
+
+
+def list_(name_prefix=None, properties=None, select=None, compact=True):
+    """
+    List (all) present datasets.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.list tank/jails properties='[used, quota]'
+
+    name_prefix
+        Filter datasets by name prefix, e.g. ``tank/jails``.
+
+    properties
+        A list of ZFS properties to retrieve. If unset, all properties
+        are retrieved.
+
+    select
+        A list of fields to return. See ``truenas_dataset.query``.
+
+    compact
+        Reduce ZFS property dicts to their ``value``. Defaults to true.
+    """
+    filters = []
+    if name_prefix:
+        filters.append(["id", "^", name_prefix])
+    return query(filters, properties=properties, select=select, compact=compact)
+
+
+def get(name, properties=None, compact=True):
+    """
+    Return a single dataset.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.get tank/media properties='[compression, recordsize]'
+
+    name
+        The name of the dataset.
+
+    properties
+        A list of ZFS properties to retrieve. If unset, all properties
+        are retrieved.
+
+    compact
+        Reduce ZFS property dicts to their ``value``. Defaults to true.
+    """
+    res = query([["id", "=", name]], properties=properties, compact=compact)
+    if not res:
+        raise CommandExecutionError(f"No such dataset: {name}")
+    return res[0]
+
+
+def exists(name):
+    """
+    Check if a dataset exists.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.exists tank/media
+
+    name
+        The name of the dataset.
+    """
+    return bool(query([["id", "=", name]], select=["id"], properties=[]))
+
+
+def create(name, **kwargs):
+    """
+    Create a dataset.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.create tank/media compression=LZ4
+
+    name
+        The name of the dataset.
+
+    kwargs
+        Parameters for ``pool.dataset.create``, e.g. ``compression``,
+        ``quota``, ``recordsize`` or ``atime``.
+    """
+    payload = {k: v for k, v in kwargs.items() if not k.startswith("_")}
+    payload["name"] = name
+    __salt__["truenas.validate"]("pool.dataset.create", payload)
+    with tn.get_client(__opts__, __context__) as client:
+        return client.call("pool.dataset.create", payload)
+
+
+def update(name, **kwargs):
+    """
+    Update a dataset.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.update tank/media compression=ZSTD atime=OFF
+
+    name
+        The name of the dataset.
+
+    kwargs
+        Parameters for ``pool.dataset.update``, e.g. ``compression``,
+        ``quota``, ``recordsize`` or ``atime``.
+    """
+    payload = {k: v for k, v in kwargs.items() if not k.startswith("_")}
+    __salt__["truenas.validate"]("pool.dataset.update", name, payload)
+    with tn.get_client(__opts__, __context__) as client:
+        return client.call("pool.dataset.update", name, payload)
+
+
+def update_many(updates, parallel=4):
+    """
+    Update many datasets concurrently over a single connection.
+
+    Returns a dict with ``results`` and ``errors``, both keyed by dataset name.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_dataset.update_many '{"tank/a": {"atime": "OFF"}, "tank/b": {"quota": 0}}'
+
+    updates
+        A mapping of dataset names to ``pool.dataset.update`` parameters.
+
+    parallel
+        The maximum number of concurrent update calls. Defaults to 4.
+    """
+    for name, payload in updates.items():
+        __salt__["truenas.validate"]("pool.dataset.update", name, payload)
+    with tn.get_client(__opts__, __context__) as client:
+        return tn.run_concurrently(
+            lambda name, payload: client.call("pool.dataset.update", name, payload),
+            ((name, (name, payload)) for name, payload in updates.items()),
+            parallel=parallel,
+        )
+
+
+def _is_id_filter(filters):
+    return (
+        len(filters) == 1
+        and isinstance(filters[0], (list, tuple))
+        and len(filters[0]) == 3
+        and list(filters[0][:2]) == ["id", "="]
+    )
@@ -0,0 +1,231 @@
+"""
+Inspect TrueNAS disks and run SMART tests.
+"""
+import logging
+import time
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_disk"
+
+TEST_TYPES = ("SHORT", "LONG", "CONVEYANCE", "OFFLINE")
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def inventory(names=None, temperatures=True):
+    """
+    Return a compact table of (all) disks with their serial, model, size,
+    temperature, last SMART test and number of failed SMART tests.
+
+    Disks, temperatures and SMART test results are each fetched with
+    a single call for all disks, concurrently.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_disk.inventory
+        salt-ssh '*' truenas_disk.inventory '[ada0, ada1]' temperatures=false
+
+    names
+        Only include these disks (e.g. ``ada0``).
+
+    temperatures
+        Include temperatures. Reading them wakes up sleeping disks
+        on some systems. Defaults to true.
+    """
+    filters = []
+    if names is not None:
+        if not isinstance(names, list):
+            names = [names]
+        names = [str(x) for x in names]
+        filters.append(["name", "in", names])
+    calls = {
+        "disks": (
+            "disk.query",
+            filters,
+            {
+                "limit": 0,
+                "select": ["identifier", "name", "serial", "model", "size", "type"],
+                "order_by": ["name"],
+            },
+        ),
+        "results": (
+            "smart.test.results",
+            [["disk", "in", names]] if names is not None else [],
+            {"limit": 0},
+        ),
+    }
+    if temperatures:
+        calls["temperatures"] = ("disk.temperatures", names or [])
+    with tn.get_client(__opts__, __context__) as client:
+        res = tn.run_concurrently(client.call, calls.items(), parallel=len(calls))
+    if "disks" in res["errors"]:
+        raise CommandExecutionError(
+            f"Failed querying disks: {res['errors']['disks']}"
+        )
+    for call, err in res["errors"].items():
+        log.warning(f"Could not fetch disk {call}: {err}")
+    temps = res["results"].get("temperatures") or {}
+    tests = {
+        result["disk"]: result.get("tests") or []
+        for result in res["results"].get("results") or []
+    }
+    ret = {}
+    for disk in res["results"]["disks"]:
+        disk_tests = tests.get(disk["name"], [])
+        ret[disk["name"]] = {
+            "serial": disk.get("serial"),
+            "model": disk.get("model"),
+            "size": disk.get("size"),
+            "type": disk.get("type"),
+            "temperature": temps.get(disk["name"]),
+            "last_test": _test(disk_tests[0]) if disk_tests else None,
+            "failed_tests": sum(
+                1
+                for entry in disk_tests
+                if entry.get("status") not in ("SUCCESS", "RUNNING", "ABORTED")
+            ),
+        }
+    return ret
+
+
+def test(names, typ="SHORT", parallel=4, poll_interval=60, timeout=None):
+    """
+    Run SMART tests on many disks, with at most ``parallel`` tests
+    running at once so that shelves are not saturated.
+
+    Tests are started through ``smart.test.manual_test`` whenever a slot
+    is free. Since there are no events for SMART test progress, the results
+    are polled every ``poll_interval`` seconds until all tests have finished.
+
+    Returns a dict with ``results`` (the last test per disk) and ``errors``
+    (mapping of disks to error messages). Disks whose test did not finish
+    in time are listed in ``errors``. Their tests keep running, so no
+    further tests are started afterwards, the remaining disks are
+    listed in ``errors`` as well.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_disk.test '[ada0, ada1, ada2, ada3]' parallel=2
+
+    names
+        A list of disk names (e.g. ``ada0``).
+
+    typ
+        The test type: ``SHORT``, ``LONG``, ``CONVEYANCE`` or ``OFFLINE``.
+        Defaults to ``SHORT``.
+
+    parallel
+        The maximum number of concurrently running tests. Defaults to 4.
+
+    poll_interval
+        The time in seconds between checks whether tests have finished.
+        Defaults to 60.
+
+    timeout
+        The maximum time in seconds to wait for each test.
+        Defaults to no limit.
+    """
+    typ = str(typ).upper()
+    if typ not in TEST_TYPES:
+        raise SaltInvocationError(
+            f"Invalid test type '{typ}'. Valid: {', '.join(TEST_TYPES)}"
+        )
+    if not isinstance(names, list):
+        names = [names]
+    names = [str(x) for x in names]
+    ret = {"results": {}, "errors": {}}
+    with tn.get_client(__opts__, __context__) as client:
+        identifiers = {
+            disk["name"]: disk["identifier"]
+            for disk in client.call(
+                "disk.query",
+                [["name", "in", names]],
+                {"limit": 0, "select": ["name", "identifier"]},
+            )
+        }
+        for name in names:
+            if name not in identifiers:
+                ret["errors"][name] = "No such disk"
+        pending = [name for name in names if name in identifiers]
+        size = max(1, int(parallel))
+        running = {}
+        stalled = False
+        while running or (pending and not stalled):
+            free = size - len(running)
+            if pending and free > 0 and not stalled:
+                wave, pending = pending[:free], pending[free:]
+                started = _start_tests(client, wave, identifiers, typ, ret["errors"])
+                running.update(dict.fromkeys(started, time.time()))
+                if not running:
+                    continue
+            # Give smartctl time to report the test as running
+            time.sleep(poll_interval)
+            last = _poll_tests(client, list(running))
+            now = time.time()
+            for name, start in list(running.items()):
+                if (last.get(name) or {}).get("status") == "RUNNING":
+                    if timeout is None or now - start < timeout:
+                        continue
+                    log.warning(f"Timed out waiting for the SMART test on {name}")
+                    ret["errors"][name] = (
+                        f"Timed out after {timeout}s, the test is still running"
+                    )
+                    # The test still occupies its slot
+                    stalled = True
+                ret["results"][name] = last.get(name)
+                running.pop(name)
+            if running:
+                log.debug(f"Waiting for SMART tests on {', '.join(running)}")
+        for name in pending:
+            ret["errors"][name] = "Not started, earlier tests did not finish in time"
+    return ret
+
+
+def _start_tests(client, wave, identifiers, typ, errors):
+    res = client.call(
+        "smart.test.manual_test",
+        [{"identifier": identifiers[name], "type": typ} for name in wave],
+    )
+    by_identifier = {ident: name for name, ident in identifiers.items()}
+    started = []
+    for status in res:
+        name = status.get("disk") or by_identifier.get(status.get("identifier"))
+        if status.get("error"):
+            errors[name] = status["error"]
+        else:
+            started.append(name)
+    log.info(f"Started {typ} SMART tests on {', '.join(started) or 'no disks'}")
+    return started
+
+
+def _poll_tests(client, names):
+    res = client.call("smart.test.results", [["disk", "in", names]], {"limit": 0})
+    return {
+        result["disk"]: _test((result.get("tests") or [None])[0]) for result in res
+    }
+
+
+def _test(entry):
+    if not entry:
+        return None
+    return {
+        "description": entry.get("description"),
+        "status": entry.get("status"),
+        "status_verbose": entry.get("status_verbose"),
+        "remaining": entry.get("remaining"),
+        "lifetime": entry.get("lifetime"),
+        "lba_of_first_error": entry.get("lba_of_first_error"),
+    }
@@ -80,6 +80,7 @@ def create(
     args = _args(
         data, typ=typ, when=when, comment=comment, enabled=enabled, timeout=timeout
     )
+    __salt__["truenas.validate"]("initshutdownscript.create", args)
     with tn.get_client(__opts__, __context__) as client:
         return client.call("initshutdownscript.create", args)
 
@@ -132,6 +133,7 @@ def update(
     args = _args(
         data, typ=typ, when=when, comment=comment, enabled=enabled, timeout=timeout
     )
+    __salt__["truenas.validate"]("initshutdownscript.update", id, args)
     with tn.get_client(__opts__, __context__) as client:
         return client.call("initshutdownscript.update", id, args)
 
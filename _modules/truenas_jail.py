@@ -11,6 +11,7 @@ log = logging.getLogger(__name__)
 
 __virtualname__ = "truenas_jail"
 __func_alias__ = {
+    "exec_": "exec",
     "list_": "list",
 }
 
@@ -192,6 +193,213 @@ def delete(name, force=False):
     return res
 
 
+def update(name, update_pkgs=False):
+    """
+    Update a jail to the latest patch level of its release.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_jail.update minio
+
+    name
+        The name (``id`` field) of the jail.
+
+    update_pkgs
+        Also update the packages inside the jail. Defaults to false.
+    """
+    with tn.get_client(__opts__, __context__) as client:
+        return client.job("jail.update_to_latest_patch", name, update_pkgs)
+
+
+def update_rolling(
+    names=None,
+    batch_size=4,
+    max_failure_rate=0.25,
+    restart=True,
+    update_pkgs=False,
+):
+    """
+    Update many jails in rolling batches. The jails of a batch are updated
+    concurrently. A running jail is only restarted after its update succeeded.
+    Remaining batches are aborted once the failure rate exceeds ``max_failure_rate``.
+
+    Only jails whose ``release`` (patch level) changed are reported as
+    ``updated`` and restarted. Package updates are not detected.
+
+    Returns a dict with ``updated``, ``restarted`` and ``skipped``
+    (lists of names), ``releases`` (mapping of updated jails to their
+    ``old`` and ``new`` release) and ``errors`` (mapping of names
+    to error messages).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_jail.update_rolling batch_size=5 max_failure_rate=0.1
+
+    names
+        A list of jail names (``id`` field). Defaults to all jails.
+
+    batch_size
+        The number of jails to update concurrently. Defaults to 4.
+
+    max_failure_rate
+        Abort the remaining batches when the ratio of failed updates to
+        processed jails exceeds this. Defaults to ``0.25``.
+
+    restart
+        Restart jails that were running after updating them. Defaults to true.
+
+    update_pkgs
+        Also update the packages inside the jails. Defaults to false.
+    """
+    ret = {"updated": [], "restarted": [], "releases": {}, "errors": {}, "skipped": []}
+    batch_size = max(1, int(batch_size))
+
+    # The release needs to be read live before and after updating
+    with tn.get_local_client(__opts__, __context__) as client:
+        jails = {
+            jail["id"]: jail
+            for jail in client.call(
+                "jail.query", [], {"limit": 0, "select": ["id", "state", "release"]}
+            )
+        }
+        if names is None:
+            names = sorted(jails)
+        unknown = [name for name in names if name not in jails]
+        if unknown:
+            raise CommandExecutionError(f"No such jail: {', '.join(unknown)}")
+
+        def update_jail(name):
+            client.job("jail.update_to_latest_patch", name, update_pkgs)
+            release = client.call(
+                "jail.query", [["id", "=", name]], {"select": ["release"]}
+            )[0]["release"]
+            if release == jails[name]["release"]:
+                return
+            ret["updated"].append(name)
+            ret["releases"][name] = {"old": jails[name]["release"], "new": release}
+            if restart and jails[name]["state"] == "up":
+                client.job("jail.restart", name)
+                ret["restarted"].append(name)
+
+        for i in range(0, len(names), batch_size):
+            batch = names[i : i + batch_size]
+            res = tn.run_concurrently(
+                update_jail, ((name, (name,)) for name in batch), parallel=batch_size
+            )
+            ret["errors"].update(res["errors"])
+            processed = i + len(batch)
+            if len(ret["errors"]) / processed > max_failure_rate:
+                ret["skipped"] = names[processed:]
+                if ret["skipped"]:
+                    log.error(
+                        f"Failure rate exceeded {max_failure_rate}, "
+                        f"aborting updates of {len(ret['skipped'])} jail(s)"
+                    )
+                break
+    return ret
+
+
+def exec_(name, command, host_user="root", jail_user=None):
+    """
+    Execute a command inside a jail and return its output.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_jail.exec minio 'pkg upgrade -y'
+
+    name
+        The name (``id`` field) of the jail.
+
+    command
+        The command to run. Either a list of arguments or a string,
+        which is passed to ``/bin/sh -c``.
+
+    host_user
+        The host user to run the command as. Defaults to ``root``.
+
+    jail_user
+        The user inside the jail to run the command as. Optional.
+    """
+    with tn.get_client(__opts__, __context__) as client:
+        return client.job("jail.exec", name, *_exec_args(command, host_user, jail_user))
+
+
+def exec_many(
+    command,
+    names=None,
+    host_user="root",
+    jail_user=None,
+    parallel=4,
+    max_failures=None,
+):
+    """
+    Execute a command inside many jails concurrently over a single connection.
+
+    Output is logged per jail as soon as it is available. Returns a dict with
+    ``results`` (output per jail), ``errors`` (error message per jail) and
+    ``skipped`` (jails that were not run after reaching ``max_failures``).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_jail.exec_many 'pkg upgrade -y' parallel=8 max_failures=2
+
+    command
+        The command to run. Either a list of arguments or a string,
+        which is passed to ``/bin/sh -c``.
+
+    names
+        A list of jail names (``id`` field). Defaults to all running jails.
+
+    host_user
+        The host user to run the command as. Defaults to ``root``.
+
+    jail_user
+        The user inside the jail to run the command as. Optional.
+
+    parallel
+        The maximum number of concurrent executions. Defaults to 4.
+
+    max_failures
+        Do not start executions in further jails once this many have failed.
+        By default, all jails are run.
+    """
+    if names is None:
+        names = [jail["id"] for jail in list_() if jail["state"] == "up"]
+    args = _exec_args(command, host_user, jail_user)
+
+    def report(name, output, error):
+        if error is not None:
+            log.error(f"[{name}] Command failed: {error}")
+        else:
+            log.info(f"[{name}] Command finished:\n{output}")
+
+    with tn.get_client(__opts__, __context__) as client:
+        return tn.run_concurrently(
+            lambda name: client.job("jail.exec", name, *args),
+            ((name, (name,)) for name in names),
+            parallel=parallel,
+            max_failures=max_failures,
+            callback=report,
+        )
+
+
+def _exec_args(command, host_user, jail_user):
+    if isinstance(command, str):
+        command = ["/bin/sh", "-c", command]
+    options = {"host_user": host_user}
+    if jail_user is not None:
+        options["jail_user"] = jail_user
+    return [list(command), options]
+
+
 def _get_jail(name):
     curr = list_(name)
     if not curr:
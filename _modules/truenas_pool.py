@@ -0,0 +1,234 @@
+"""
+Inspect TrueNAS pool health and follow scrubs/resilvers.
+"""
+import logging
+import threading
+import time
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import CommandExecutionError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_pool"
+
+SCAN_FIELDS = (
+    "function",
+    "state",
+    "percentage",
+    "errors",
+    "start_time",
+    "end_time",
+    "bytes_processed",
+    "bytes_to_process",
+)
+ERROR_FIELDS = ("read_errors", "write_errors", "checksum_errors")
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def health(names=None, devices=False):
+    """
+    Return a compact health summary of (all) pools from a single query:
+    ``status``, ``healthy``, ``warning`` and the last or current ``scan``
+    (scrub/resilver).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_pool.health
+        salt-ssh '*' truenas_pool.health '[tank]' devices=true
+
+    names
+        Only include these pools.
+
+    devices
+        Also include the summed read/write/checksum ``errors`` and the
+        devices that are not ``ONLINE``. This requires fetching
+        the pool topology. Defaults to false.
+    """
+    filters = []
+    if names is not None:
+        if not isinstance(names, list):
+            names = [names]
+        filters.append(["name", "in", [str(x) for x in names]])
+    select = ["id", "name", "status", "healthy", "warning", "scan"]
+    if devices:
+        select.append("topology")
+    # ensure we don't get paged results
+    options = {"limit": 0, "select": select, "order_by": ["name"]}
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.call("pool.query", filters, options)
+    ret = {}
+    for pool in res:
+        summary = {
+            "id": pool["id"],
+            "status": pool.get("status"),
+            "healthy": pool.get("healthy"),
+            "warning": pool.get("warning"),
+            "scan": _scan(pool.get("scan")),
+        }
+        if devices:
+            summary.update(_device_summary(pool.get("topology") or {}))
+        ret[pool["name"]] = summary
+    return ret
+
+
+def scrub(name, wait=False, timeout=None):
+    """
+    Start a scrub of a pool.
+
+    Without ``wait``, returns the job ID. Otherwise blocks until the scrub
+    has finished (driven by job progress updates, not polling) and returns
+    the final scan status.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_pool.scrub tank wait=true
+
+    name
+        The name of the pool.
+
+    wait
+        Wait for the scrub to finish. Defaults to false.
+
+    timeout
+        When waiting, the maximum time in seconds. The scrub job is aborted
+        afterwards. Use ``truenas_pool.wait_scan`` to only stop waiting.
+        Defaults to no limit.
+    """
+    pool_id = _get_pool(name)["id"]
+    with tn.get_client(__opts__, __context__) as client:
+        if not wait:
+            return client.call("pool.scrub", pool_id, "START")
+        client.job(
+            "pool.scrub",
+            pool_id,
+            "START",
+            timeout=timeout,
+            callback=_progress_logger(f"Scrub of {name}"),
+        )
+    return _scan(_get_pool(name).get("scan"))
+
+
+def wait_scan(name, timeout=None):
+    """
+    Block until the current scrub or resilver of a pool has finished
+    and return its final status. Returns immediately if none is running.
+
+    Follows ``zfs.pool.scan`` events instead of polling the pool status.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_pool.wait_scan tank timeout=86400
+
+    name
+        The name of the pool.
+
+    timeout
+        The maximum time in seconds to wait. Defaults to no limit.
+    """
+    finished = threading.Event()
+    last = {}
+
+    def callback(mtype, **message):  # pylint: disable=unused-argument
+        fields = message.get("fields") or {}
+        if fields.get("name") != name or not fields.get("scan"):
+            return
+        last["scan"] = fields["scan"]
+        if fields["scan"].get("state") != "SCANNING":
+            finished.set()
+
+    # Subscriptions need a live connection
+    with tn.get_local_client(__opts__, __context__) as client:
+        client.subscribe("zfs.pool.scan", callback)
+        # Check after subscribing to not miss the end of the scan
+        scan = _get_pool(name, client).get("scan") or {}
+        if scan.get("state") != "SCANNING":
+            return _scan(scan)
+        log.info(f"Waiting for {scan.get('function', 'scan')} of {name}")
+        if not finished.wait(timeout):
+            progress = (_scan(last.get("scan", scan)) or {}).get("percentage")
+            raise CommandExecutionError(
+                f"Timed out after {timeout}s waiting for the scan of {name}. "
+                f"Last progress: {progress}%"
+            )
+    return _scan(last["scan"])
+
+
+def _get_pool(name, client=None):
+    if client is None:
+        with tn.get_client(__opts__, __context__) as client:
+            return _get_pool(name, client)
+    res = client.call(
+        "pool.query",
+        [["name", "=", name]],
+        {"select": ["id", "name", "scan"]},
+    )
+    if not res:
+        raise CommandExecutionError(f"No such pool: {name}")
+    return res[0]
+
+
+def _scan(scan):
+    if not scan:
+        return None
+    ret = {field: scan.get(field) for field in SCAN_FIELDS}
+    for field in ("start_time", "end_time"):
+        # Timestamps are returned as {"$date": <ms>}
+        if isinstance(ret[field], dict) and "$date" in ret[field]:
+            ret[field] = ret[field]["$date"] / 1000
+    if ret["percentage"] is not None:
+        ret["percentage"] = round(ret["percentage"], 2)
+    return ret
+
+
+def _device_summary(topology):
+    errors = dict.fromkeys(ERROR_FIELDS, 0)
+    degraded = []
+
+    def walk(vdev):
+        stats = vdev.get("stats") or {}
+        if not vdev.get("children"):
+            for field in ERROR_FIELDS:
+                errors[field] += stats.get(field) or 0
+            if vdev.get("status") not in (None, "ONLINE"):
+                degraded.append(
+                    {
+                        "name": vdev.get("disk") or vdev.get("name"),
+                        "status": vdev.get("status"),
+                    }
+                )
+        for child in vdev.get("children") or []:
+            walk(child)
+
+    for vdevs in topology.values():
+        for vdev in vdevs or []:
+            walk(vdev)
+    return {"errors": errors, "degraded": degraded}
+
+
+def _progress_logger(prefix):
+    last = {"time": 0}
+
+    def callback(job):
+        progress = job.get("progress") or {}
+        # Do not flood the log, progress updates can be frequent
+        if time.time() - last["time"] < 60:
+            return
+        last["time"] = time.time()
+        log.info(
+            f"{prefix}: {progress.get('percent')}% {progress.get('description') or ''}"
+        )
+
+    return callback
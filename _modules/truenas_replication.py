@@ -0,0 +1,316 @@
+"""
+Monitor and run TrueNAS replication tasks.
+"""
+import logging
+import re
+import threading
+import time
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import CommandExecutionError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_replication"
+__func_alias__ = {
+    "list_": "list",
+}
+
+LIST_FIELDS = [
+    "id",
+    "name",
+    "enabled",
+    "direction",
+    "transport",
+    "source_datasets",
+    "target_dataset",
+    "state",
+    "job",
+]
+
+JOB_FIELDS = ("id", "state", "progress", "error", "time_started", "time_finished")
+
+# e.g. "Sending 3 of 12: tank/a@auto-1 (1.21 GiB / 10 GiB)"
+PROGRESS_BYTES = re.compile(
+    r"\(\s*([\d.]+)\s*([KMGTPE]?i?B?)\s*/\s*([\d.]+)\s*([KMGTPE]?i?B?)\s*\)"
+)
+UNITS = "KMGTPE"
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def list_(names=None, select=None):
+    """
+    List (all) replication tasks with their last state, from a single query.
+
+    Returned entries contain the task ``state`` (``state``, ``datetime``,
+    ``error``, ``last_snapshot``) and the ``job`` of the last/current run,
+    reduced to ``id``, ``state``, ``progress``, ``error``, ``time_started``
+    and ``time_finished``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_replication.list
+        salt-ssh '*' truenas_replication.list select='[id, name, state]'
+
+    names
+        Only list these tasks.
+
+    select
+        A list of fields to return. Defaults to a compact set
+        of fields useful for monitoring.
+    """
+    filters = []
+    if names is not None:
+        if not isinstance(names, list):
+            names = [names]
+        filters.append(["name", "in", [str(x) for x in names]])
+    if not select:
+        select = LIST_FIELDS
+    elif not isinstance(select, list):
+        select = [select]
+    # ensure we don't get paged results
+    options = {"limit": 0, "select": [str(x) for x in select], "order_by": ["name"]}
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.call("replication.query", filters, options)
+    for task in res:
+        if task.get("job"):
+            task["job"] = _compact_job(task["job"])
+    return res
+
+
+def throughput(names=None, duration=30):
+    """
+    Measure the throughput of running replication tasks by following
+    their job progress events for ``duration`` seconds.
+
+    Returns a mapping of task names to ``bytes_per_second`` (over all
+    snapshots sent during ``duration``), ``transferred`` and ``total``
+    bytes of the current snapshot, ``percent``, ``percent_per_second``
+    and ``eta`` (seconds). Values that cannot be derived from the progress
+    updates are ``None``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_replication.throughput duration=60
+
+    names
+        Only include these tasks.
+
+    duration
+        The time in seconds to sample progress for. Defaults to 30.
+    """
+    running = {
+        task["job"]["id"]: task["name"]
+        for task in list_(names, select=["id", "name", "job"])
+        if task.get("job") and task["job"].get("state") == "RUNNING"
+    }
+    if not running:
+        return {}
+    rates = {job_id: _Rate() for job_id in running}
+
+    def callback(mtype, **message):  # pylint: disable=unused-argument
+        fields = message.get("fields") or {}
+        job_id = fields.get("id", message.get("id"))
+        if job_id in rates:
+            rates[job_id].add(fields.get("progress"))
+
+    # Subscriptions need a live connection
+    with tn.get_local_client(__opts__, __context__) as client:
+        client.subscribe("core.get_jobs", callback)
+        # Start with the current progress
+        for job in client.call(
+            "core.get_jobs",
+            [["id", "in", list(running)]],
+            {"select": ["id", "progress"]},
+        ):
+            rates[job["id"]].add(job.get("progress"))
+        time.sleep(float(duration))
+    return {running[job_id]: rate.summary() for job_id, rate in rates.items()}
+
+
+def run_many(names, parallel=None, timeout=None):
+    """
+    Run several replication tasks concurrently and wait for all of them.
+
+    Returns a dict with ``results``, ``errors`` (mapping of task names
+    to error messages) and ``skipped``. ``results`` maps task names to the
+    run ``duration``, the bytes ``transferred`` (summed over the snapshots
+    that appeared in job progress updates) and the resulting average
+    ``bytes_per_second`` over the whole run. The latter two are ``None``
+    if the progress updates did not contain byte counts.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_replication.run_many '[offsite-media, offsite-backup]'
+
+    names
+        A list of replication task names.
+
+    parallel
+        The maximum number of tasks running at once. Defaults to all.
+
+    timeout
+        The maximum time in seconds to wait for each task. Runs that take
+        longer are aborted and listed in ``errors``. Defaults to no limit.
+    """
+    if not isinstance(names, list):
+        names = [names]
+    tasks = {task["name"]: task["id"] for task in list_(names, select=["id", "name"])}
+    missing = [name for name in names if name not in tasks]
+    if missing:
+        raise CommandExecutionError(
+            f"No such replication tasks: {', '.join(missing)}"
+        )
+
+    def run(name):
+        rate = _Rate()
+        start = time.time()
+        client.job(
+            "replication.run",
+            tasks[name],
+            timeout=timeout,
+            callback=lambda job: rate.add(job.get("progress")),
+        )
+        duration = time.time() - start
+        # The job succeeded, so the last snapshot was sent completely
+        transferred = rate.transferred(finished=True)
+        return {
+            "duration": round(duration, 1),
+            "transferred": transferred,
+            "bytes_per_second": (
+                round(transferred / duration)
+                if transferred is not None and duration > 0
+                else None
+            ),
+        }
+
+    with tn.get_client(__opts__, __context__) as client:
+        return tn.run_concurrently(
+            run,
+            ((name, (name,)) for name in names),
+            parallel=parallel or len(names),
+            callback=_log_finished,
+        )
+
+
+def _log_finished(name, result, error):
+    if error:
+        log.warning(f"Replication {name} failed: {error}")
+    else:
+        log.info(f"Replication {name} finished in {result['duration']}s")
+
+
+def _compact_job(job):
+    ret = {field: job.get(field) for field in JOB_FIELDS}
+    for field in ("time_started", "time_finished"):
+        # Timestamps are returned as {"$date": <ms>}
+        if isinstance(ret[field], dict) and "$date" in ret[field]:
+            ret[field] = ret[field]["$date"] / 1000
+    return ret
+
+
+def _parse_bytes(num, unit):
+    factor = 1
+    if unit and unit[0] in UNITS:
+        factor = 1024 ** (UNITS.index(unit[0]) + 1)
+    return float(num) * factor
+
+
+class _Rate:
+    """
+    Collects job progress samples and derives throughput from them.
+    """
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+        # Bytes of snapshots that were sent completely
+        self._done = 0
+        self._snapshot = None
+
+    def add(self, progress):
+        if not progress:
+            return
+        sample = {"time": time.time(), "percent": progress.get("percent")}
+        description = progress.get("description") or ""
+        match = PROGRESS_BYTES.search(description)
+        with self._lock:
+            if match:
+                sample["transferred"] = _parse_bytes(*match.group(1, 2))
+                sample["total"] = _parse_bytes(*match.group(3, 4))
+                # Byte counters restart with each snapshot, which is
+                # named in the rest of the description
+                name = PROGRESS_BYTES.sub("", description).strip()
+                prev = self._snapshot
+                if prev is not None and (
+                    name != prev["name"] or sample["transferred"] < prev["transferred"]
+                ):
+                    self._done += prev["total"]
+                self._snapshot = {
+                    "name": name,
+                    "transferred": sample["transferred"],
+                    "total": sample["total"],
+                }
+                sample["bytes"] = self._done + sample["transferred"]
+            self.samples.append(sample)
+
+    def transferred(self, finished=False):
+        """
+        Return the bytes transferred over all snapshots seen so far,
+        counting the current one completely if ``finished``.
+        None if no progress update contained byte counts.
+        """
+        with self._lock:
+            if self._snapshot is None:
+                return None
+            current = self._snapshot["total" if finished else "transferred"]
+            return round(self._done + current)
+
+    def summary(self):
+        with self._lock:
+            samples = list(self.samples)
+        ret = dict.fromkeys(
+            (
+                "bytes_per_second",
+                "transferred",
+                "total",
+                "percent",
+                "percent_per_second",
+                "eta",
+            )
+        )
+        if not samples:
+            return ret
+        last = samples[-1]
+        ret["percent"] = last["percent"]
+        ret["transferred"] = last.get("transferred")
+        ret["total"] = last.get("total")
+        with_bytes = [s for s in samples if "bytes" in s]
+        if len(with_bytes) > 1 and with_bytes[-1]["time"] > with_bytes[0]["time"]:
+            first, end = with_bytes[0], with_bytes[-1]
+            rate = (end["bytes"] - first["bytes"]) / (end["time"] - first["time"])
+            ret["bytes_per_second"] = round(max(rate, 0))
+            if rate > 0 and ret["total"] is not None:
+                ret["eta"] = round((ret["total"] - ret["transferred"]) / rate)
+        with_percent = [s for s in samples if s["percent"] is not None]
+        if len(with_percent) > 1 and last["time"] > with_percent[0]["time"]:
+            rate = (with_percent[-1]["percent"] - with_percent[0]["percent"]) / (
+                with_percent[-1]["time"] - with_percent[0]["time"]
+            )
+            ret["percent_per_second"] = round(rate, 4)
+            # The percentage covers all snapshots, prefer it for the ETA
+            if rate > 0:
+                ret["eta"] = round((100 - with_percent[-1]["percent"]) / rate)
+        return ret
@@ -0,0 +1,288 @@
+"""
+Export TrueNAS reporting data.
+
+Exports are written as one NumPy ``.npy`` file per graph plus an
+``index.json`` describing them, without requiring NumPy on the host.
+Load them with:
+
+.. code-block:: python
+
+    import json
+    import numpy as np
+
+    index = json.load(open("export/index.json"))
+    for graph in index["graphs"]:
+        data = np.load(f"export/{graph['file']}")
+        times = graph["start"] + np.arange(len(data)) * graph["step"]
+"""
+import logging
+import math
+import os
+import re
+import struct
+import sys
+import time
+from array import array
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_reporting"
+
+UNITS = ("HOUR", "DAY", "WEEK", "MONTH", "YEAR")
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def graphs():
+    """
+    List available graphs and their identifiers.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_reporting.graphs
+    """
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.call("reporting.graphs", [], {"limit": 0})
+    return {graph["name"]: graph.get("identifiers") for graph in res}
+
+
+def get_data(graphs, start=None, end=None, unit=None, aggregate=False):
+    """
+    Fetch data for many graphs in a single ``reporting.get_data`` call.
+
+    The resolution is chosen by TrueNAS depending on the time range,
+    longer ranges return consolidated (coarser) data.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_reporting.get_data '[cpu, "disk:ada0"]' unit=DAY
+
+    graphs
+        A list of graphs. Items can be graph names, ``name:identifier``
+        strings or dicts with ``name`` and ``identifier``. Graph names
+        without an identifier are expanded to all available identifiers.
+
+    start
+        The start of the time range as a UNIX timestamp. Negative values
+        are relative to now, e.g. ``-604800`` for the last week.
+
+    end
+        The end of the time range as a UNIX timestamp. Negative values
+        are relative to now. Defaults to now.
+
+    unit
+        Instead of ``start``/``end``, request the last
+        ``HOUR``, ``DAY``, ``WEEK``, ``MONTH`` or ``YEAR``.
+
+    aggregate
+        Let the server compute min/mean/max per legend entry
+        (``aggregations`` in the result). Defaults to false.
+    """
+    query = _query(start, end, unit, aggregate)
+    with tn.get_client(__opts__, __context__) as client:
+        return client.call("reporting.get_data", _graphs(client, graphs), query)
+
+
+def export(
+    path, graphs, start=None, end=None, unit=None, aggregate=False, max_points=None
+):
+    """
+    Fetch data for many graphs in a single call and write it to ``path``
+    as one ``.npy`` file (float64, one row per time step, one column per
+    legend entry, gaps as NaN) per graph and an ``index.json``.
+
+    Returns the index, which lists the file, legend, ``start``, ``end``
+    and ``step`` of each graph.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_reporting.export /mnt/tank/export '[cpu, disk, arcsize]' start=-2592000 max_points=2000
+
+    path
+        The directory to write the export to. Created if missing.
+
+    graphs
+        A list of graphs, see ``truenas_reporting.get_data``.
+
+    start
+        The start of the time range, see ``truenas_reporting.get_data``.
+
+    end
+        The end of the time range, see ``truenas_reporting.get_data``.
+
+    unit
+        Instead of ``start``/``end``, request the last
+        ``HOUR``, ``DAY``, ``WEEK``, ``MONTH`` or ``YEAR``.
+
+    aggregate
+        Include server-side min/mean/max per legend entry in the index.
+        Defaults to false.
+
+    max_points
+        Average consecutive rows while writing so that each graph has
+        at most this many rows. The ``step`` in the index is adjusted.
+    """
+    res = get_data(graphs, start=start, end=end, unit=unit, aggregate=aggregate)
+    os.makedirs(path, exist_ok=True)
+    index = {"created": time.time(), "graphs": []}
+    used = set()
+    # Release the series as they are written, they can be large
+    res.reverse()
+    while res:
+        graph = res.pop()
+        fname = _filename(graph["name"], graph.get("identifier"), used)
+        rows = graph.get("data") or []
+        legend = graph.get("legend") or []
+        width = len(legend) or max((len(row) for row in rows), default=0)
+        factor = 1
+        if max_points and len(rows) > int(max_points):
+            factor = math.ceil(len(rows) / int(max_points))
+        written = _write_npy(
+            os.path.join(path, fname), _downsample(rows, width, factor), width
+        )
+        entry = {
+            "name": graph["name"],
+            "identifier": graph.get("identifier"),
+            "file": fname,
+            "legend": legend,
+            "rows": written,
+            "start": graph.get("start"),
+            "end": graph.get("end"),
+            "step": (graph.get("step") or 0) * factor,
+        }
+        if aggregate:
+            entry["aggregations"] = graph.get("aggregations")
+        index["graphs"].append(entry)
+    tn.write_cache(os.path.join(path, "index.json"), index)
+    return index
+
+
+def _query(start, end, unit, aggregate):
+    query = {"aggregate": bool(aggregate)}
+    if unit is not None:
+        if start is not None or end is not None:
+            raise SaltInvocationError("Specify either `unit` or `start`/`end`")
+        unit = str(unit).upper()
+        if unit not in UNITS:
+            raise SaltInvocationError(
+                f"Invalid unit '{unit}'. Valid: {', '.join(UNITS)}"
+            )
+        query["unit"] = unit
+        query["page"] = 1
+        return query
+    now = int(time.time())
+    for key, val in (("start", start), ("end", end)):
+        if val is None:
+            continue
+        val = int(val)
+        query[key] = now + val if val < 0 else val
+    if "start" not in query:
+        raise SaltInvocationError("Either `unit` or `start` is required")
+    query.setdefault("end", now)
+    return query
+
+
+def _graphs(client, graphs):
+    if not isinstance(graphs, list):
+        graphs = [graphs]
+    ret = []
+    expand = []
+    for graph in graphs:
+        if isinstance(graph, dict):
+            ret.append({"name": graph["name"], "identifier": graph.get("identifier")})
+            continue
+        name, _, identifier = str(graph).partition(":")
+        if identifier:
+            ret.append({"name": name, "identifier": identifier})
+        else:
+            expand.append(name)
+    if expand:
+        available = {
+            graph["name"]: graph.get("identifiers")
+            for graph in client.call(
+                "reporting.graphs",
+                [["name", "in", expand]],
+                {"select": ["name", "identifiers"], "limit": 0},
+            )
+        }
+        for name in expand:
+            if name not in available:
+                raise CommandExecutionError(f"No such graph: {name}")
+            for identifier in available[name] or [None]:
+                ret.append({"name": name, "identifier": identifier})
+    return ret
+
+
+def _filename(name, identifier, used):
+    base = name if identifier is None else f"{name}__{identifier}"
+    base = re.sub(r"[^\w.-]", "_", base)
+    fname = f"{base}.npy"
+    i = 1
+    while fname in used:
+        fname = f"{base}_{i}.npy"
+        i += 1
+    used.add(fname)
+    return fname
+
+
+def _downsample(rows, width, factor):
+    """
+    Yield rows of ``width`` floats, averaging ``factor`` consecutive
+    rows and ignoring gaps.
+    """
+    for i in range(0, len(rows), factor):
+        sums = [0.0] * width
+        counts = [0] * width
+        for row in rows[i : i + factor]:
+            for col, val in enumerate(row[:width]):
+                if val is None:
+                    continue
+                try:
+                    val = float(val)
+                except (TypeError, ValueError):
+                    continue
+                if math.isnan(val):
+                    continue
+                sums[col] += val
+                counts[col] += 1
+        yield [s / c if c else math.nan for s, c in zip(sums, counts)]
+
+
+def _write_npy(path, rows, width):
+    """
+    Write rows of floats as a 2D little-endian float64 array in the
+    NPY 1.0 format. The shape is patched into the header afterwards,
+    so ``rows`` can be an iterator.
+    """
+    # Reserve enough space for any shape, keeping the data 64-byte aligned
+    header_len = 118
+    with open(path, "wb") as f:
+        f.write(b"\0" * (10 + header_len))
+        count = 0
+        for row in rows:
+            data = array("d", row)
+            if sys.byteorder == "big":
+                data.byteswap()
+            data.tofile(f)
+            count += 1
+        header = str(
+            {"descr": "<f8", "fortran_order": False, "shape": (count, width)}
+        ).encode("latin1")
+        header = header.ljust(header_len - 1) + b"\n"
+        f.seek(0)
+        f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", header_len) + header)
+    return count
@@ -8,7 +8,7 @@ import logging
 
 import salt.utils.path
 import truenasutils as tn
-from salt.exceptions import SaltInvocationError
+from salt.exceptions import CommandExecutionError, SaltInvocationError
 from salt.utils.immutabletypes import freeze
 
 log = logging.getLogger(__name__)
@@ -16,8 +16,15 @@ log = logging.getLogger(__name__)
 __virtualname__ = "truenas_service"
 __func_alias__ = {"reload_": "reload"}
 
+IKEY = "truenas_service.alias_index"
+# Name of the on-disk cache, changed when the index is built differently
+ICACHE = "service_aliases_v2"
 
-# mapping of API namespace to service name alias(es)
+
+# Mapping of API namespace to service name alias(es).
+# This is the fallback if the API cannot be introspected and the source
+# of aliases otherwise. Entries not present in the running version
+# (like the deprecated ``afp`` and ``s3``) are ignored then.
 API_SERVICE_ALIASES = freeze(
     {
         "afp": set(),
@@ -334,6 +341,51 @@ def get_config(name, include_private_keys=False):
     return ret
 
 
+def get_configs(names, include_private_keys=False, parallel=8):
+    """
+    Return several service configurations, read concurrently
+    over a single connection.
+    This is TrueNAS-specific.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_service.get_configs '[ftp, webdav, system.general]'
+
+    names
+        A list of service names. Examples: ``cifs``, ``ssh``, ``ups``.
+
+    include_private_keys
+        When querying the ``ssh`` configuration, also include
+        private key contents in the output. Defaults to false.
+
+    parallel
+        The maximum number of concurrent calls. Defaults to 8.
+    """
+    namespaces = {name: _get_api_ns(name) for name in names}
+    with tn.get_client(__opts__, __context__) as client:
+        res = tn.run_concurrently(
+            lambda ns: client.call(f"{ns}.config"),
+            ((name, (ns,)) for name, ns in namespaces.items()),
+            parallel=parallel,
+        )
+    if res["errors"]:
+        raise CommandExecutionError(
+            "Failed reading service configuration: "
+            + ", ".join(f"{name}: {err}" for name, err in res["errors"].items())
+        )
+    ret = res["results"]
+    for name, ns in namespaces.items():
+        if ns == "ssh" and not include_private_keys:
+            ret[name] = {
+                conf: val
+                for conf, val in ret[name].items()
+                if not (conf.startswith("host_") and conf.endswith("_key"))
+            }
+    return ret
+
+
 def update_config(name, **kwargs):
     """
     Update a service configuration.
@@ -350,12 +402,147 @@ def update_config(name, **kwargs):
     """
     ns = _get_api_ns(name)
     payload = {k: v for k, v in kwargs.items() if not k.startswith("_")}
+    __salt__["truenas.validate"](f"{ns}.update", payload)
     with tn.get_client(__opts__, __context__) as client:
         return client.call(f"{ns}.update", payload)
 
 
+def update_configs(updates, parallel=4):
+    """
+    Update several service configurations concurrently over a single
+    connection. Returns a dict with ``results`` and ``errors``,
+    both keyed by service name.
+    This is TrueNAS-specific.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_service.update_configs '{"ftp": {"ssltls_certificate": 3}, "webdav": {"certssl": 3}}'
+
+    updates
+        A mapping of service names to configuration updates.
+
+    parallel
+        The maximum number of concurrent calls. Defaults to 4.
+    """
+    payloads = {}
+    for name, payload in updates.items():
+        ns = _get_api_ns(name)
+        payload = {k: v for k, v in payload.items() if not k.startswith("_")}
+        __salt__["truenas.validate"](f"{ns}.update", payload)
+        payloads[name] = (ns, payload)
+    with tn.get_client(__opts__, __context__) as client:
+        return tn.run_concurrently(
+            lambda ns, payload: client.call(f"{ns}.update", payload),
+            ((name, args) for name, args in payloads.items()),
+            parallel=parallel,
+        )
+
+
+def validate_config(name, **kwargs):
+    """
+    Validate a service configuration update locally against the API schema.
+    Raises an error describing all invalid parameters.
+    This is TrueNAS-specific.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_service.validate_config ssh tcpport=22
+
+    name
+        The name of the service. Examples: ``cifs``, ``ssh``, ``ups``.
+    """
+    ns = _get_api_ns(name)
+    payload = {k: v for k, v in kwargs.items() if not k.startswith("_")}
+    return __salt__["truenas.validate"](f"{ns}.update", payload)
+
+
+def list_namespaces():
+    """
+    List the API namespaces of service configurations
+    that can be managed with ``get_config``/``update_config``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_service.list_namespaces
+    """
+    return sorted(set(_alias_index().values()))
+
+
+def list_aliases():
+    """
+    Return the mapping of service names and aliases to API namespaces
+    for the running TrueNAS version.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_service.list_aliases
+    """
+    return dict(_alias_index())
+
+
 def _get_api_ns(service):
-    for ns, aliases in API_SERVICE_ALIASES.items():
-        if service == ns or service in aliases:
-            return ns
-    raise SaltInvocationError(f"Unknown service '{service}'")
+    try:
+        return _alias_index()[service]
+    except KeyError:
+        raise SaltInvocationError(f"Unknown service '{service}'")
+
+
+def _alias_index():
+    """
+    Build the reverse index of service names/aliases to API namespaces
+    once per TrueNAS version. Known namespaces are included if the running
+    system provides their ``config`` and ``update`` methods. Other
+    configurable namespaces are discovered from the API methods and
+    the services the running system provides.
+    """
+    if IKEY in __context__:
+        return __context__[IKEY]
+    version = __grains__.get("truenas_version_str")
+    index = tn.load_versioned(__opts__, ICACHE, version)
+    if index is None:
+        index, discovered = _build_alias_index(version)
+        if discovered:
+            tn.store_versioned(__opts__, ICACHE, version, index)
+    __context__[IKEY] = index
+    return index
+
+
+def _build_alias_index(version):
+    try:
+        methods = tn.get_methods(__opts__, __context__, version=version)
+        with tn.get_client(__opts__, __context__) as client:
+            services = {
+                x["service"]
+                for x in client.call("service.query", [], {"select": ["service"]})
+            }
+    except Exception as err:  # pylint: disable=broad-except
+        log.warning(f"Could not discover service namespaces, using defaults: {err}")
+        namespaces = set(API_SERVICE_ALIASES)
+        discovered = False
+    else:
+        discovered = True
+        namespaces = set()
+        for method in methods:
+            if not method.endswith(".config"):
+                continue
+            ns = method[: -len(".config")]
+            if f"{ns}.update" not in methods:
+                continue
+            # Explicitly managed namespaces only need to exist, others
+            # are only included when they belong to a service
+            if ns in API_SERVICE_ALIASES or ns in services:
+                namespaces.add(ns)
+    index = {}
+    for ns in namespaces:
+        index[ns] = ns
+        for alias in API_SERVICE_ALIASES.get(ns, ()):
+            index.setdefault(alias, ns)
+    return index, discovered
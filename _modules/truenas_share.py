@@ -0,0 +1,167 @@
+"""
+Operate on TrueNAS SMB and NFS shares.
+"""
+import logging
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_share"
+__func_alias__ = {
+    "list_": "list",
+    "reload_": "reload",
+}
+
+# share type: (API namespace, service)
+SHARE_TYPES = {
+    "nfs": ("sharing.nfs", "nfs"),
+    "smb": ("sharing.smb", "cifs"),
+}
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def list_(typ, select=None):
+    """
+    List (all) shares of a type.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_share.list smb select='[id, name, path, enabled]'
+
+    typ
+        The share type, either ``smb`` or ``nfs``.
+
+    select
+        A list of fields to return. Defaults to all.
+    """
+    # ensure we don't get paged results
+    options = {"limit": 0, "order_by": ["id"]}
+    if select:
+        if not isinstance(select, list):
+            select = [select]
+        options["select"] = [str(x) for x in select]
+    with tn.get_client(__opts__, __context__) as client:
+        return client.call(f"{_ns(typ)}.query", [], options)
+
+
+def key(typ, share):
+    """
+    Return the identifying key of a share: the name of SMB shares
+    and the (first) path of NFS shares.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_share.key nfs '{"path": "/mnt/tank/media"}'
+
+    typ
+        The share type, either ``smb`` or ``nfs``.
+
+    share
+        The share parameters.
+    """
+    _ns(typ)
+    if typ == "smb":
+        return share.get("name")
+    # NFS shares on TrueNAS CORE can have multiple ``paths``
+    if share.get("path"):
+        return share["path"]
+    return (share.get("paths") or [None])[0]
+
+
+def apply(typ, create=None, update=None, delete=None, parallel=4):
+    """
+    Create, update and delete many shares concurrently over a single
+    connection. Does not reload the sharing service, see
+    ``truenas_share.reload``.
+
+    Returns a dict with ``created``, ``updated`` and ``deleted``
+    (lists of share keys/IDs) and ``errors`` (mapping of share keys/IDs
+    to error messages).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_share.apply smb create='[{"name": "media", "path": "/mnt/tank/media"}]' delete='[7]'
+
+    typ
+        The share type, either ``smb`` or ``nfs``.
+
+    create
+        A list of share parameters to create.
+
+    update
+        A mapping of share IDs to the parameters to update.
+
+    delete
+        A list of share IDs to delete.
+
+    parallel
+        The maximum number of concurrent calls. Defaults to 4.
+    """
+    ns = _ns(typ)
+    create = create or []
+    update = {int(ident): payload for ident, payload in (update or {}).items()}
+    delete = [int(ident) for ident in delete or []]
+    for payload in create:
+        __salt__["truenas.validate"](f"{ns}.create", payload)
+    for ident, payload in update.items():
+        __salt__["truenas.validate"](f"{ns}.update", ident, payload)
+    items = [
+        (("create", key(typ, payload)), (f"{ns}.create", payload))
+        for payload in create
+    ]
+    items += [
+        (("update", ident), (f"{ns}.update", ident, payload))
+        for ident, payload in update.items()
+    ]
+    items += [(("delete", ident), (f"{ns}.delete", ident)) for ident in delete]
+    with tn.get_client(__opts__, __context__) as client:
+        res = tn.run_concurrently(client.call, items, parallel=parallel)
+    ret = {"created": [], "updated": [], "deleted": [], "errors": {}}
+    for (action, ident), err in res["errors"].items():
+        ret["errors"][ident] = f"Failed to {action}: {err}"
+    for action, ident in res["results"]:
+        ret[f"{action}d"].append(ident)
+    return ret
+
+
+def reload_(typ):
+    """
+    Reload the sharing service of a share type if it is running.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_share.reload smb
+
+    typ
+        The share type, either ``smb`` or ``nfs``.
+    """
+    _ns(typ)
+    service = SHARE_TYPES[typ][1]
+    if not __salt__["truenas_service.status"](service):
+        return False
+    __salt__["truenas_service.reload"](service)
+    return True
+
+
+def _ns(typ):
+    if typ not in SHARE_TYPES:
+        raise SaltInvocationError(
+            f"Invalid share type '{typ}'. Valid: {', '.join(SHARE_TYPES)}"
+        )
+    return SHARE_TYPES[typ][0]
@@ -0,0 +1,235 @@
+"""
+Inspect and prune TrueNAS ZFS snapshots.
+"""
+import logging
+import time
+
+import salt.utils.path
+import truenasutils as tn
+from salt.exceptions import SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_snapshot"
+__func_alias__ = {
+    "list_": "list",
+}
+
+
+def __virtual__():
+    if salt.utils.path.which("midclt"):
+        return __virtualname__
+    return False, "Does not seem to be TrueNAS"
+
+
+def list_(dataset=None, recursive=False, name_prefix=None):
+    """
+    List snapshots with their creation time.
+
+    Only the ``creation`` property is retrieved. Returned entries contain
+    ``name``, ``dataset``, ``snapshot_name`` and ``creation`` (epoch seconds).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_snapshot.list tank/media recursive=true
+
+    dataset
+        Only list snapshots of this dataset.
+
+    recursive
+        Include snapshots of child datasets. Defaults to false.
+
+    name_prefix
+        Only list snapshots whose name (the part after ``@``) starts with this.
+    """
+    return list(_iter_snapshots(dataset, recursive=recursive, name_prefix=name_prefix))
+
+
+def grouped(dataset=None, recursive=False, name_prefix=None):
+    """
+    List snapshots grouped by dataset, sorted by creation time (oldest first).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_snapshot.grouped tank recursive=true
+
+    dataset
+        Only list snapshots of this dataset.
+
+    recursive
+        Include snapshots of child datasets. Defaults to false.
+
+    name_prefix
+        Only list snapshots whose name (the part after ``@``) starts with this.
+    """
+    return _group(_iter_snapshots(dataset, recursive=recursive, name_prefix=name_prefix))
+
+
+def retention(
+    dataset=None, keep_last=None, keep_daily=None, recursive=False, name_prefix=None
+):
+    """
+    Apply a retention policy and return the snapshots to keep and to prune,
+    grouped by dataset. Does not delete anything.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_snapshot.retention tank/media keep_last=10 keep_daily=14
+
+    dataset
+        Only consider snapshots of this dataset.
+
+    keep_last
+        Keep the newest N snapshots of each dataset.
+
+    keep_daily
+        For the newest N days with snapshots, keep the newest snapshot
+        of each day (UTC) for each dataset.
+
+    recursive
+        Include snapshots of child datasets. Defaults to false.
+
+    name_prefix
+        Only consider snapshots whose name (the part after ``@``) starts with this.
+        Other snapshots are neither pruned nor counted.
+    """
+    if keep_last is None and keep_daily is None:
+        raise SaltInvocationError(
+            "Refusing to apply a retention policy without `keep_last` or `keep_daily`"
+        )
+    groups = grouped(dataset, recursive=recursive, name_prefix=name_prefix)
+    ret = {}
+    for ds, snaps in groups.items():
+        keep = _retained(snaps, keep_last=keep_last, keep_daily=keep_daily)
+        ret[ds] = {
+            "keep": [snap["name"] for snap in snaps if snap["name"] in keep],
+            "prune": [snap["name"] for snap in snaps if snap["name"] not in keep],
+        }
+    return ret
+
+
+def delete_many(names, batch_size=100):
+    """
+    Delete many snapshots in batches via ``core.bulk``. The middleware
+    runs these jobs one after another.
+
+    Returns a dict with ``deleted`` (list of names) and ``errors``
+    (mapping of names to error messages).
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_snapshot.delete_many '[tank/a@manual-1, tank/a@manual-2]'
+
+    names
+        A list of full snapshot names (``dataset@snapshot``).
+
+    batch_size
+        The number of snapshots to delete per ``core.bulk`` job.
+        Defaults to 100.
+    """
+    ret = {"deleted": [], "errors": {}}
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.bulk("zfs.snapshot.delete", names, batch_size=batch_size)
+    for name, status in zip(names, res):
+        if status["error"]:
+            ret["errors"][name] = status["error"]
+        else:
+            ret["deleted"].append(name)
+    return ret
+
+
+def prune(
+    dataset=None,
+    keep_last=None,
+    keep_daily=None,
+    recursive=False,
+    name_prefix=None,
+    batch_size=100,
+):
+    """
+    Apply a retention policy and delete pruned snapshots in batches.
+    See ``truenas_snapshot.retention`` and ``truenas_snapshot.delete_many``.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-ssh '*' truenas_snapshot.prune tank recursive=true keep_last=10 name_prefix=manual-
+    """
+    policy = retention(
+        dataset,
+        keep_last=keep_last,
+        keep_daily=keep_daily,
+        recursive=recursive,
+        name_prefix=name_prefix,
+    )
+    names = [name for ds in policy.values() for name in ds["prune"]]
+    return delete_many(names, batch_size=batch_size)
+
+
+def _iter_snapshots(dataset=None, recursive=False, name_prefix=None):
+    filters = []
+    if dataset:
+        if recursive:
+            filters.append(
+                ["OR", [["dataset", "=", dataset], ["dataset", "^", f"{dataset}/"]]]
+            )
+        else:
+            filters.append(["dataset", "=", dataset])
+    if name_prefix:
+        filters.append(["snapshot_name", "^", name_prefix])
+    # ensure we don't get paged results
+    options = {
+        "limit": 0,
+        "select": ["id", "dataset", "snapshot_name", "properties"],
+        "extra": {"properties": ["creation"]},
+    }
+    with tn.get_client(__opts__, __context__) as client:
+        res = client.call("zfs.snapshot.query", filters, options)
+    res.reverse()
+    while res:
+        # Release the raw records as we go, there can be many of them
+        snap = tn.compact_properties(res.pop(), field="rawvalue")
+        yield {
+            "name": snap["id"],
+            "dataset": snap["dataset"],
+            "snapshot_name": snap["snapshot_name"],
+            "creation": int(snap["properties"]["creation"]),
+        }
+
+
+def _group(snapshots):
+    groups = {}
+    for snap in snapshots:
+        groups.setdefault(snap["dataset"], []).append(snap)
+    for snaps in groups.values():
+        snaps.sort(key=lambda x: x["creation"])
+    return groups
+
+
+def _retained(snaps, keep_last=None, keep_daily=None):
+    """
+    Expects ``snaps`` to be sorted by creation time, oldest first.
+    """
+    keep = set()
+    if keep_last:
+        keep.update(snap["name"] for snap in snaps[-int(keep_last) :])
+    if keep_daily:
+        days = set()
+        for snap in reversed(snaps):
+            day = time.strftime("%Y-%m-%d", time.gmtime(snap["creation"]))
+            if day in days:
+                continue
+            if len(days) >= int(keep_daily):
+                break
+            days.add(day)
+            keep.add(snap["name"])
+    return keep
@@ -0,0 +1,144 @@
+"""
+Gather inventory from many TrueNAS systems concurrently.
+
+Hosts are configured on the master:
+
+.. code-block:: yaml
+
+    truenas_hosts:
+      nas01:
+        uri: wss://nas01.example.com/websocket
+        api_key: 1-abcdef
+      nas02:
+        uri: wss://nas02.example.com/websocket
+        username: root
+        password: hunter2
+        verify_ssl: false
+"""
+import concurrent.futures
+import logging
+import time
+
+import truenasutils as tn
+from salt.exceptions import SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas"
+
+INVENTORY_CALLS = {
+    "product_type": ("system.product_type",),
+    "version": ("system.version",),
+    "services": (
+        "service.query",
+        [],
+        {"select": ["service", "state", "enable"], "limit": 0},
+    ),
+    "certificates": (
+        "certificate.query",
+        [],
+        {"select": ["name", "from", "until", "expired"], "limit": 0},
+    ),
+    "jails": ("jail.query", [], {"select": ["id", "state", "release"], "limit": 0}),
+}
+
+
+def __virtual__():
+    if tn.HAS_PYTHON_CLIENT:
+        return __virtualname__
+    return False, "The middlewared Python client is not installed"
+
+
+def inventory(hosts=None, parallel=10, timeout=30):
+    """
+    Query product/version, services, certificate expiry and jail states
+    from many TrueNAS systems concurrently and return an aggregated report.
+
+    A full sweep takes about as long as the slowest host. Hosts that do
+    not respond within ``timeout`` are reported with an error.
+
+    CLI Example:
+
+    .. code-block:: bash
+
+        salt-run truenas.inventory
+        salt-run truenas.inventory hosts='[nas01, nas02]' timeout=10
+
+    hosts
+        A list of host names from ``truenas_hosts`` to query.
+        Defaults to all configured hosts.
+
+    parallel
+        The maximum number of hosts to query concurrently. Defaults to 10.
+
+    timeout
+        The time in seconds to wait for each host. Defaults to 30.
+    """
+    configured = __opts__.get("truenas_hosts") or {}
+    if hosts is None:
+        hosts = list(configured)
+    unknown = [host for host in hosts if host not in configured]
+    if unknown:
+        raise SaltInvocationError(f"Unknown hosts: {', '.join(unknown)}")
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel))
+    started = {}
+    futures = {}
+    for host in hosts:
+        futures[pool.submit(_query_host, configured[host], timeout, started, host)] = host
+    ret = {}
+    pending = set(futures)
+    # Hosts waiting for a worker have not used up their timeout yet,
+    # but do not wait forever if workers hang
+    rounds = -(-len(hosts) // max(1, parallel))
+    final = time.time() + timeout * (rounds + 1)
+    while pending:
+        now = time.time()
+        deadline = min(started.get(futures[f], now) + timeout for f in pending)
+        deadline = min(deadline, final)
+        done, pending = concurrent.futures.wait(
+            pending,
+            timeout=max(0, deadline - now),
+            return_when=concurrent.futures.FIRST_COMPLETED,
+        )
+        for future in done:
+            try:
+                ret[futures[future]] = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                ret[futures[future]] = {"error": str(err)}
+        now = time.time()
+        for future in list(pending):
+            host = futures[future]
+            if now >= final or host in started and now - started[host] >= timeout:
+                future.cancel()
+                pending.discard(future)
+                ret[host] = {"error": "Timed out"}
+    # Do not wait for hung connections
+    pool.shutdown(wait=False)
+    return {host: ret[host] for host in sorted(ret)}
+
+
+def _query_host(config, timeout, started, host):
+    started[host] = time.time()
+    client = tn.get_remote_client(
+        config["uri"],
+        api_key=config.get("api_key"),
+        username=config.get("username"),
+        password=config.get("password"),
+        verify_ssl=config.get("verify_ssl", True),
+        timeout=timeout,
+    )
+    with client:
+        res = tn.run_concurrently(
+            lambda func, *args: client.call(func, *args, timeout=timeout),
+            INVENTORY_CALLS.items(),
+            parallel=len(INVENTORY_CALLS),
+        )
+    ret = res["results"]
+    # Jails do not exist on SCALE
+    if "jails" in res["errors"]:
+        ret["jails"] = None
+        res["errors"].pop("jails")
+    if res["errors"]:
+        ret["errors"] = res["errors"]
+    return ret
@@ -0,0 +1,309 @@
+"""
+Manage TrueNAS users and groups.
+"""
+import logging
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_account"
+
+# These parameters cannot be compared to the current state
+CREATE_ONLY = {
+    "group": ("allow_duplicate_gid",),
+    "user": ("group_create", "password"),
+}
+
+
+def __virtual__():
+    try:
+        __salt__["truenas_account.list_users"]
+    except KeyError:
+        return False, "`truenas_account` execution module not found"
+    return __virtualname__
+
+
+def managed(name, users=None, groups=None, prune=False, batch_size=None):
+    """
+    Ensure users and groups are configured as specified.
+
+    Current accounts are fetched with one projected ``group.query`` and
+    ``user.query``, the diff is computed locally and each kind of change
+    is applied as a single ``core.bulk`` job. Groups are managed before
+    users, so users can reference new groups by name. Both are planned
+    and validated before anything is changed.
+
+    Passwords are only set when creating users.
+
+    .. code-block:: yaml
+
+        Accounts are managed:
+          truenas_account.managed:
+            - groups:
+                - name: media
+                  gid: 3001
+            - users:
+                - username: jellyfin
+                  full_name: Jellyfin
+                  uid: 3001
+                  group: media
+                  groups:
+                    - video
+                  home: /mnt/tank/home/jellyfin
+                  password_disabled: true
+
+    name
+        An arbitrary name for this state.
+
+    users
+        A list of users (``user.create`` parameters). Each needs
+        a ``username``. ``group`` and ``groups`` can be given as group
+        names or IDs. If unset, users are not managed.
+
+    groups
+        A list of groups (``group.create`` parameters). Each needs
+        a ``name``. If unset, groups are not managed.
+
+    prune
+        Delete users/groups of a managed type that are not in its list.
+        Builtin accounts are never deleted. Defaults to false.
+
+    batch_size
+        Split each kind of change into ``core.bulk`` jobs of this size.
+        Defaults to a single job.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "All accounts are already in the correct state",
+        "changes": {},
+    }
+    applied = []
+    try:
+        errors = {}
+        group_ids = None
+        pending = set()
+        group_plan = user_plan = None
+        if groups is not None:
+            group_plan = _plan_groups(groups, prune)
+            group_ids = group_plan["ids"]
+            pending = set(group_plan["changes"].get("created", []))
+        if users is not None:
+            # Plan users before changing groups, so invalid users
+            # fail the state before anything was written
+            user_plan = _plan_users(users, prune, group_ids, pending)
+        for typ, plan in (("group", group_plan), ("user", user_plan)):
+            if plan is not None and not __opts__["test"]:
+                _validate(typ, plan, pending)
+        if group_plan and group_plan["changes"]:
+            ret["changes"]["groups"] = group_plan["changes"]
+            if not __opts__["test"]:
+                applied.append("groups")
+                _apply("group", group_plan, batch_size, ret, errors)
+                if group_plan["create"] and user_plan is not None:
+                    # Need the IDs of the new groups
+                    user_plan = _plan_users(users, prune)
+        if user_plan and user_plan["changes"]:
+            ret["changes"]["users"] = user_plan["changes"]
+            if not __opts__["test"]:
+                applied.append("users")
+                _apply("user", user_plan, batch_size, ret, errors)
+        if not ret["changes"] and not errors:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "Would have " + _summary(ret["changes"])
+        elif errors:
+            ret["result"] = False
+            ret["comment"] = "Failed managing some accounts:\n" + "\n".join(
+                f"{account}: {err}" for account, err in sorted(errors.items())
+            )
+        else:
+            summary = _summary(ret["changes"])
+            ret["comment"] = summary[:1].upper() + summary[1:]
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        # Keep the changes that were already made
+        ret["changes"] = {
+            typ: changes for typ, changes in ret["changes"].items() if typ in applied
+        }
+        if ret["changes"]:
+            ret["comment"] += "\nHave " + _summary(ret["changes"])
+    return ret
+
+
+def _plan_groups(groups, prune):
+    wanted = _index(groups, "name", "group")
+    fields = _fields(wanted, "group") - {"name"}
+    curr = {
+        group["group"]: group
+        for group in __salt__["truenas_account.list_groups"](
+            select=sorted({"id", "group", "builtin"}.union(fields))
+        )
+    }
+    plan = _plan("group", wanted, curr, prune, _compare_group)
+    plan["ids"] = {group: curr[group]["id"] for group in curr}
+    return plan
+
+
+def _plan_users(users, prune, group_ids=None, pending=()):
+    wanted = _index(users, "username", "user")
+    by_name = any(
+        not isinstance(grp, int)
+        for user in wanted.values()
+        for grp in [user.get("group", 0)] + list(user.get("groups", []))
+    )
+    if by_name and group_ids is None:
+        group_ids = {
+            group["group"]: group["id"]
+            for group in __salt__["truenas_account.list_groups"](
+                select=["id", "group"]
+            )
+        }
+    for user in wanted.values():
+        if "group" in user:
+            user["group"] = _group_id(user["group"], group_ids, pending)
+        if "groups" in user:
+            user["groups"] = sorted(
+                (_group_id(grp, group_ids, pending) for grp in user["groups"]),
+                key=str,
+            )
+    fields = _fields(wanted, "user")
+    curr = {
+        user["username"]: user
+        for user in __salt__["truenas_account.list_users"](
+            select=sorted({"id", "username", "builtin"}.union(fields))
+        )
+    }
+    return _plan("user", wanted, curr, prune, _compare_user)
+
+
+def _index(accounts, field, typ):
+    if not isinstance(accounts, list):
+        raise SaltInvocationError(f"`{typ}s` must be a list")
+    index = {}
+    for account in accounts:
+        ident = account.get(field)
+        if not ident:
+            raise SaltInvocationError(f"Every {typ} needs a `{field}`")
+        if ident in index:
+            raise SaltInvocationError(f"Duplicate {typ}: {ident}")
+        index[ident] = dict(account)
+    return index
+
+
+def _fields(wanted, typ):
+    fields = {field for account in wanted.values() for field in account}
+    return fields.difference(CREATE_ONLY[typ])
+
+
+def _group_id(group, group_ids, pending):
+    if isinstance(group, int):
+        return group
+    if group in group_ids:
+        return group_ids[group]
+    # Groups that would be created in test mode do not have an ID yet
+    if group in pending:
+        return group
+    raise SaltInvocationError(f"No such group: {group}")
+
+
+def _compare_group(field, wanted, curr):
+    if field == "name":
+        return True
+    return wanted == curr.get(field)
+
+
+def _compare_user(field, wanted, curr):
+    if field == "group":
+        return wanted == (curr.get("group") or {}).get("id")
+    if field == "groups":
+        return wanted == sorted(curr.get("groups") or [], key=str)
+    return wanted == curr.get(field)
+
+
+def _plan(typ, wanted, curr, prune, compare):
+    plan = {
+        "create": [],
+        "update": {},
+        "delete": [],
+        "keys": {},
+        "changes": {"created": [], "updated": {}, "deleted": []},
+    }
+    for ident, account in wanted.items():
+        if ident not in curr:
+            plan["create"].append(account)
+            plan["keys"][ident] = ident
+            plan["changes"]["created"].append(ident)
+            continue
+        changed = {
+            field: val
+            for field, val in account.items()
+            if field not in CREATE_ONLY[typ] and not compare(field, val, curr[ident])
+        }
+        if changed:
+            plan["update"][curr[ident]["id"]] = changed
+            plan["keys"][curr[ident]["id"]] = ident
+            plan["changes"]["updated"][ident] = {
+                field: {"old": curr[ident].get(field), "new": val}
+                for field, val in changed.items()
+            }
+    if prune:
+        for ident, account in curr.items():
+            if ident not in wanted and not account.get("builtin"):
+                plan["delete"].append(account["id"])
+                plan["keys"][account["id"]] = ident
+                plan["changes"]["deleted"].append(ident)
+    plan["changes"] = {
+        action: changes for action, changes in plan["changes"].items() if changes
+    }
+    return plan
+
+
+def _validate(typ, plan, pending):
+    def resolved(payload):
+        # Users referencing new groups are validated once they exist
+        refs = [payload.get("group")] + list(payload.get("groups", []))
+        return not any(grp in pending for grp in refs)
+
+    for payload in plan["create"]:
+        if resolved(payload):
+            __salt__["truenas.validate"](f"{typ}.create", payload)
+    for ident, payload in plan["update"].items():
+        if resolved(payload):
+            __salt__["truenas.validate"](f"{typ}.update", ident, payload)
+
+
+def _apply(typ, plan, batch_size, ret, errors):
+    res = __salt__["truenas_account.apply"](
+        typ,
+        create=plan["create"],
+        update=plan["update"],
+        delete=plan["delete"],
+        batch_size=batch_size,
+    )
+    changes = ret["changes"][f"{typ}s"]
+    for ident, err in res["errors"].items():
+        account = plan["keys"].get(ident, ident)
+        errors[f"{typ} {account}"] = err
+        if account in changes.get("created", []):
+            changes["created"].remove(account)
+        changes.get("updated", {}).pop(account, None)
+        if account in changes.get("deleted", []):
+            changes["deleted"].remove(account)
+    for action in list(changes):
+        if not changes[action]:
+            changes.pop(action)
+    if not changes:
+        ret["changes"].pop(f"{typ}s")
+
+
+def _summary(changes):
+    parts = []
+    for typ, actions in changes.items():
+        for action in ("created", "updated", "deleted"):
+            if actions.get(action):
+                parts.append(f"{action} {len(actions[action])} {typ[:-1]}(s)")
+    return ", ".join(parts)
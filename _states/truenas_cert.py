@@ -63,12 +63,9 @@ def imported(name, certificate, private_key, append_certs=None, clean=True):
         Defaults to true.
     """
 
-    def list_expired(certs):
-        expired = []
-        for cert in certs:
-            if __salt__["x509.expires"](cert["certificate"]):
-                expired.append(cert["name"])
-        return expired
+    def list_expired():
+        certs = __salt__["truenas_cert.list"](name, select=["name", "expired"])
+        return [cert["name"] for cert in certs if cert.get("expired")]
 
     ret = {
         "name": name,
@@ -79,7 +76,7 @@ def imported(name, certificate, private_key, append_certs=None, clean=True):
     expired = []
     try:
         try:
-            wanted = __salt__["x509.encode_certificate"](
+            wanted = __salt__["truenas_cert.fingerprint"](
                 certificate, append_certs=append_certs
             )
         except SaltInvocationError as err:
@@ -93,17 +90,15 @@ def imported(name, certificate, private_key, append_certs=None, clean=True):
             ] = "Could not load the certificate. If it's a path and created before, you can ignore this message."
             return ret
         actual_name = f"{name}-{int(time.time())}"
-        certs = __salt__["truenas_cert.list"](name, order_by="name")
-        if certs:
-            curr = certs[-1]
-            if wanted == curr["certificate"]:
-                return ret
-            verb = "reimport"
-        else:
-            verb = "import"
+        present = __salt__["truenas_cert.fingerprints"](name)
+        # Only the latest certificate is activated by `truenas_cert.active`,
+        # so an older one with the same fingerprint does not count
+        if present and present[max(present)] == wanted:
+            return ret
+        verb = "reimport" if present else "import"
         ret["changes"][f"{verb}ed"] = actual_name
         if clean:
-            expired = list_expired(certs)
+            expired = list_expired()
         if __opts__["test"]:
             ret["result"] = None
             ret["comment"] = f"The certificate would have been {verb}ed"
@@ -115,13 +110,13 @@ def imported(name, certificate, private_key, append_certs=None, clean=True):
         )
         # Give it some time
         time.sleep(5)
-        new = __salt__["truenas_cert.list"](actual_name)
-        if not new:
+        new = __salt__["truenas_cert.fingerprints"](actual_name)
+        if actual_name not in new:
             raise CommandExecutionError(
                 "No errors during import, but the certificate was not listed as present"
             )
-        if new[-1]["certificate"] != wanted:
-            log.debug(f"Wanted:\n{wanted}\nActual:\n{new[-1]['certificate']}")
+        if new[actual_name] != wanted:
+            log.debug(f"Wanted fingerprint: {wanted}\nActual: {new[actual_name]}")
             raise CommandExecutionError(
                 "Certificate was imported, but it did not match what was expected"
             )
@@ -144,7 +139,7 @@ def imported(name, certificate, private_key, append_certs=None, clean=True):
     return ret
 
 
-def active(name, certificate_name):
+def active(name, certificate_name, ui_restart=True):
     """
     Ensure the latest named certificate is active for a service.
 
@@ -154,6 +149,11 @@ def active(name, certificate_name):
     certificate_name
         The name of the certificate that was passed to ``truenas_cert.imported``.
         The latest iteration will be selected.
+
+    ui_restart
+        When the ``system.general`` certificate changed, restart the web UI.
+        Defaults to true. Disable this if the restart is coordinated
+        elsewhere, e.g. when several states change the UI certificate.
     """
     ret = {
         "name": name,
@@ -191,7 +191,7 @@ def active(name, certificate_name):
         kwarg = {cert_config: curr["id"]}
         __salt__["truenas_service.update_config"](name, **kwarg)
         ret["comment"] = "Updated the certificate config"
-        if name == "system.general":
+        if name == "system.general" and ui_restart:
             # Restart UI on changes - other services might need this also
             try:
                 __salt__["truenas.call"]("system.general.ui_restart")
@@ -205,3 +205,98 @@ def active(name, certificate_name):
         ret["comment"] = str(err)
         ret["changes"] = {}
     return ret
+
+
+def active_many(name, scopes, ui_restart=True):
+    """
+    Ensure the latest named certificate is active for several services.
+
+    The latest certificate is resolved once, all current configurations
+    are read in one batch and only necessary updates are sent.
+    The web UI is restarted at most once at the end.
+
+    .. code-block:: yaml
+
+        my-cert:
+          truenas_cert.active_many:
+            - scopes:
+              - system.general
+              - ftp
+              - webdav
+
+    name
+        The name of the certificate that was passed to ``truenas_cert.imported``.
+        The latest iteration will be selected.
+
+    scopes
+        A list of scopes where it should be active.
+
+    ui_restart
+        When the ``system.general`` certificate changed, restart the web UI.
+        Defaults to true.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "The certificate is already active",
+        "changes": {},
+    }
+    try:
+        invalid = [scope for scope in scopes if scope not in CERT_CONFIGS]
+        if invalid:
+            raise SaltInvocationError(
+                f"Cannot manage service(s) {', '.join(invalid)}. "
+                f"Allowed: {', '.join(CERT_CONFIGS)}"
+            )
+        certs = __salt__["truenas_cert.list"](
+            name, order_by="name", select=["id", "name"]
+        )
+        if not certs:
+            err_msg = f"Did not find a certificate with name prefix '{name}'"
+            if __opts__["test"]:
+                ret["result"] = None
+                ret[
+                    "comment"
+                ] = f"{err_msg}. If the certificate is imported before, you can ignore this message"
+                return ret
+            raise CommandExecutionError(err_msg)
+        curr = certs[-1]
+        configs = __salt__["truenas_service.get_configs"](scopes)
+        updates = {}
+        for scope in scopes:
+            curr_config = configs[scope][CERT_CONFIGS[scope]]
+            if curr_config and curr_config["id"] == curr["id"]:
+                continue
+            updates[scope] = {CERT_CONFIGS[scope]: curr["id"]}
+            ret["changes"][scope] = {
+                "old": curr_config["name"] if curr_config else None,
+                "new": curr["name"],
+            }
+        if not updates:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "Would have updated the certificate config"
+            return ret
+        res = __salt__["truenas_service.update_configs"](updates)
+        for scope in res["errors"]:
+            ret["changes"].pop(scope)
+        ret["comment"] = "Updated the certificate config"
+        if res["errors"]:
+            ret["result"] = False
+            ret["comment"] = "Failed updating the certificate config for " + ", ".join(
+                f"{scope}: {err}" for scope, err in res["errors"].items()
+            )
+        if "system.general" in ret["changes"] and ui_restart:
+            try:
+                __salt__["truenas.call"]("system.general.ui_restart")
+            except Exception as err:
+                ret["result"] = False
+                ret["comment"] += f". Failed restarting UI: {err}"
+            else:
+                ret["changes"]["restarted"] = "system.general"
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
@@ -0,0 +1,155 @@
+"""
+Manage TrueNAS datasets.
+"""
+import logging
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_dataset"
+
+
+def __virtual__():
+    try:
+        __salt__["truenas_dataset.query"]
+    except KeyError:
+        return False, "`truenas_dataset` execution module not found"
+    return __virtualname__
+
+
+def managed(name, datasets, create=True, parallel=4):
+    """
+    Ensure many datasets have their properties set as specified.
+
+    Current values are fetched with a single projected query, the diff
+    is computed locally and only necessary updates are sent, concurrently.
+
+    .. code-block:: yaml
+
+        Media datasets are managed:
+          truenas_dataset.managed:
+            - datasets:
+                tank/media:
+                  compression: LZ4
+                  atime: 'OFF'
+                tank/media/photos:
+                  recordsize: 1M
+                  quota: INHERIT
+
+    name
+        An arbitrary name for this state.
+
+    datasets
+        A mapping of dataset names to the wanted properties.
+        The special value ``INHERIT`` matches inherited or default values.
+
+    create
+        Create missing datasets. Parents are created before their children.
+        Defaults to true. When false, missing datasets are an error.
+
+    parallel
+        The maximum number of concurrent update calls. Defaults to 4.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "All datasets are already in the correct state",
+        "changes": {},
+    }
+    try:
+        if not isinstance(datasets, dict):
+            raise SaltInvocationError("`datasets` must be a mapping")
+        props = sorted({prop for wanted in datasets.values() for prop in wanted})
+        curr = {
+            ds["id"]: ds
+            for ds in __salt__["truenas_dataset.query"](
+                [["id", "in", list(datasets)]], properties=props, compact=False
+            )
+        }
+        missing = sorted(ds for ds in datasets if ds not in curr)
+        if missing and not create:
+            raise CommandExecutionError(f"Missing datasets: {', '.join(missing)}")
+        updates = {}
+        for ds, wanted in datasets.items():
+            if ds not in curr:
+                continue
+            changed = {
+                prop: val
+                for prop, val in wanted.items()
+                if not _matches(val, curr[ds].get(prop))
+            }
+            if changed:
+                updates[ds] = changed
+                ret["changes"][ds] = {
+                    prop: {"old": _display(curr[ds].get(prop)), "new": val}
+                    for prop, val in changed.items()
+                }
+        for ds in missing:
+            ret["changes"][ds] = {"created": datasets[ds]}
+        if not ret["changes"]:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = (
+                f"Would have created {len(missing)} and "
+                f"updated {len(updates)} dataset(s)"
+            )
+            return ret
+
+        # Validate everything before the first write, so invalid parameters
+        # do not leave the datasets partially managed
+        for ds in missing:
+            __salt__["truenas.validate"](
+                "pool.dataset.create", dict(datasets[ds], name=ds)
+            )
+        for ds, payload in updates.items():
+            __salt__["truenas.validate"]("pool.dataset.update", ds, payload)
+
+        errors = {}
+        # Sorting by name ensures parents are created first
+        for ds in missing:
+            try:
+                __salt__["truenas_dataset.create"](ds, **datasets[ds])
+            except (CommandExecutionError, SaltInvocationError) as err:
+                errors[ds] = str(err)
+        if updates:
+            res = __salt__["truenas_dataset.update_many"](updates, parallel=parallel)
+            errors.update(res["errors"])
+        for ds in errors:
+            ret["changes"].pop(ds, None)
+        if errors:
+            ret["result"] = False
+            ret["comment"] = "Failed managing some datasets:\n" + "\n".join(
+                f"{ds}: {err}" for ds, err in sorted(errors.items())
+            )
+        else:
+            ret["comment"] = (
+                f"Created {len(missing)} and updated {len(updates)} dataset(s)"
+            )
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
+
+
+def _matches(wanted, prop):
+    if not isinstance(prop, dict):
+        return wanted == prop
+    if str(wanted).upper() == "INHERIT":
+        return prop.get("source") in ("INHERITED", "DEFAULT")
+    # The API accepts different representations than it returns
+    # (e.g. ``LZ4`` vs ``lz4``, ``10G`` vs ``10737418240``)
+    for field in ("value", "rawvalue", "parsed"):
+        if prop.get(field) == wanted:
+            return True
+        if str(prop.get(field)).lower() == str(wanted).lower():
+            return True
+    return False
+
+
+def _display(prop):
+    if isinstance(prop, dict):
+        return prop.get("value")
+    return prop
@@ -195,6 +195,80 @@ def absent(name, force=False):
     return ret
 
 
+def updated(
+    name,
+    jails=None,
+    batch_size=4,
+    max_failure_rate=0.25,
+    restart=True,
+    update_pkgs=False,
+):
+    """
+    Ensure jails are updated to the latest patch level, in rolling batches.
+
+    Since there is no cheap way to check for available patches,
+    this always runs the update. Only jails whose patch level changed
+    are reported and restarted.
+
+    name
+        An arbitrary name for this state.
+
+    jails
+        A list of jail names (``id`` field). Defaults to all jails.
+
+    batch_size
+        The number of jails to update concurrently. Defaults to 4.
+
+    max_failure_rate
+        Abort the remaining batches when the ratio of failed updates to
+        processed jails exceeds this. Defaults to ``0.25``.
+
+    restart
+        Restart jails that were running after updating them. Defaults to true.
+
+    update_pkgs
+        Also update the packages inside the jails. Defaults to false.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "The jails are already at the latest patch level",
+        "changes": {},
+    }
+    try:
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "The jails would have been checked for updates"
+            return ret
+        res = __salt__["truenas_jail.update_rolling"](
+            names=jails,
+            batch_size=batch_size,
+            max_failure_rate=max_failure_rate,
+            restart=restart,
+            update_pkgs=update_pkgs,
+        )
+        if res["releases"]:
+            ret["changes"]["updated"] = res["releases"]
+            ret["comment"] = f"Updated {len(res['releases'])} jail(s)"
+        if res["restarted"]:
+            ret["changes"]["restarted"] = res["restarted"]
+        if res["errors"] or res["skipped"]:
+            ret["result"] = False
+            ret["comment"] = "Failed updating some jails:\n" + "\n".join(
+                f"{jail}: {err}" for jail, err in sorted(res["errors"].items())
+            )
+            if res["skipped"]:
+                ret["comment"] += (
+                    "\nAborted after exceeding the failure rate, skipped: "
+                    + ", ".join(res["skipped"])
+                )
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
+
+
 def mod_watch(name, sfun=None, **kwargs):
     """
     Support the ``watch`` requisite for ``truenas_jail.running`` and ``truenas_jail.dead``.
@@ -10,6 +10,9 @@ log = logging.getLogger(__name__)
 
 __virtualname__ = "truenas_service"
 
+# Tracks which services were restarted/reloaded by listeners during this run
+WKEY = "truenas_service.watch_actions"
+
 
 def __virtual__():
     try:
@@ -44,6 +47,8 @@ def configured(name, **kwargs):
     try:
         if not __salt__["truenas_service.available"](name):
             raise SaltInvocationError(f"Unknown service: {name}")
+        # Fail early on invalid parameters, without querying the config
+        __salt__["truenas_service.validate_config"](name, **kwargs)
         curr = __salt__["truenas_service.get_config"](name)
         changes = check_changes(curr)
         if not changes:
@@ -69,3 +74,170 @@ def configured(name, **kwargs):
         ret["result"] = False
         ret["comment"] = str(err)
     return ret
+
+
+def running(name, enable=None, reload=False):  # pylint: disable=unused-argument
+    """
+    Ensure a TrueNAS service is running.
+
+    Supports the ``watch`` and ``listen`` requisites. Prefer ``listen``
+    to coalesce restarts: Salt then triggers the restart once at the end
+    of the run, and if several listening states target the same service,
+    it is restarted or reloaded only once.
+
+    name
+        The name of the service. Examples: ``cifs``, ``ssh``, ``ups``.
+
+    enable
+        Also ensure the service is enabled (true) or disabled (false)
+        at boot. By default, this is not managed.
+
+    reload
+        When triggered by ``watch``/``listen``, reload the service
+        instead of restarting it. Defaults to false.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "The service is already in the correct state",
+        "changes": {},
+    }
+    try:
+        if not __salt__["truenas_service.available"](name):
+            raise SaltInvocationError(f"Unknown service: {name}")
+        if enable is not None and __salt__["truenas_service.enabled"](name) != enable:
+            ret["changes"]["enabled"] = enable
+        if not __salt__["truenas_service.status"](name):
+            ret["changes"]["started"] = name
+        if not ret["changes"]:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "Would have started/enabled the service"
+            return ret
+        if "enabled" in ret["changes"]:
+            func = "enable" if enable else "disable"
+            __salt__[f"truenas_service.{func}"](name)
+        if "started" in ret["changes"]:
+            __salt__["truenas_service.start"](name)
+            if not __salt__["truenas_service.status"](name):
+                raise CommandExecutionError(
+                    "Tried to start the service, but it is still not running"
+                )
+        ret["comment"] = "The service is in the correct state"
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
+
+
+def dead(name, enable=None):
+    """
+    Ensure a TrueNAS service is stopped.
+
+    name
+        The name of the service. Examples: ``cifs``, ``ssh``, ``ups``.
+
+    enable
+        Also ensure the service is enabled (true) or disabled (false)
+        at boot. By default, this is not managed.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "The service is already in the correct state",
+        "changes": {},
+    }
+    try:
+        if not __salt__["truenas_service.available"](name):
+            raise SaltInvocationError(f"Unknown service: {name}")
+        if enable is not None and __salt__["truenas_service.enabled"](name) != enable:
+            ret["changes"]["enabled"] = enable
+        if __salt__["truenas_service.status"](name):
+            ret["changes"]["stopped"] = name
+        if not ret["changes"]:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "Would have stopped/disabled the service"
+            return ret
+        if "enabled" in ret["changes"]:
+            func = "enable" if enable else "disable"
+            __salt__[f"truenas_service.{func}"](name)
+        if "stopped" in ret["changes"]:
+            __salt__["truenas_service.stop"](name)
+            if __salt__["truenas_service.status"](name):
+                raise CommandExecutionError(
+                    "Tried to stop the service, but it is still running"
+                )
+        ret["comment"] = "The service is in the correct state"
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
+
+
+def mod_watch(name, sfun=None, reload=False, **kwargs):
+    """
+    Support the ``watch`` and ``listen`` requisites for
+    ``truenas_service.running`` and ``truenas_service.dead``.
+
+    When triggered by ``listen`` (at the end of the run), each service
+    is restarted or reloaded at most once, even if several states request it.
+    A restart satisfies pending reload requests.
+    """
+    ret = {"name": name, "changes": {}, "result": True, "comment": ""}
+    if sfun not in ("running", "dead"):
+        ret["result"] = False
+        ret["comment"] = f"Unable to trigger watch for truenas_service.{sfun}"
+        return ret
+    try:
+        is_running = __salt__["truenas_service.status"](name)
+        if sfun == "dead":
+            if not is_running:
+                ret["comment"] = "Service is already stopped"
+                return ret
+            verb, func = "stopped", "stop"
+        elif not is_running:
+            verb, func = "started", "start"
+        elif reload:
+            verb, func = "reloaded", "reload"
+        else:
+            verb, func = "restarted", "restart"
+
+        listener = _is_listener()
+        done = __context__.setdefault(WKEY, {})
+        if listener and func in ("restart", "reload"):
+            if done.get(name) in ("restart", func):
+                ret["comment"] = f"Service was already {done[name]}ed during this run"
+                return ret
+
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = f"Service is set to be {verb}"
+            ret["changes"][verb] = name
+            return ret
+
+        __salt__[f"truenas_service.{func}"](name)
+        if listener and func in ("restart", "reload", "start"):
+            done[name] = "restart" if func == "start" else func
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        return ret
+    ret["comment"] = f"Service was {verb}"
+    ret["changes"][verb] = name
+    return ret
+
+
+def _is_listener():
+    """
+    Salt runs ``listen`` requisites at the end of the run
+    as chunks with an ID prefixed with ``listener_``.
+    """
+    try:
+        return str(__low__.get("__id__", "")).startswith("listener_")
+    except NameError:
+        return False
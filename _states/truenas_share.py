@@ -0,0 +1,200 @@
+"""
+Manage TrueNAS SMB and NFS shares.
+"""
+import logging
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_share"
+
+
+def __virtual__():
+    try:
+        __salt__["truenas_share.list"]
+    except KeyError:
+        return False, "`truenas_share` execution module not found"
+    return __virtualname__
+
+
+def managed(name, smb=None, nfs=None, prune=False, parallel=4, reload=True):
+    """
+    Ensure SMB/NFS shares are configured as specified.
+
+    For each share type, current shares are fetched with a single projected
+    query and indexed by name (SMB) or path (NFS). Creates, updates and
+    deletions are computed locally and applied concurrently. Afterwards,
+    each affected sharing service is reloaded once.
+
+    .. code-block:: yaml
+
+        Shares are managed:
+          truenas_share.managed:
+            - smb:
+                - name: media
+                  path: /mnt/tank/media
+                  ro: true
+                - name: backup
+                  path: /mnt/tank/backup
+            - nfs:
+                - path: /mnt/tank/media
+                  networks:
+                    - 10.1.0.0/24
+            - prune: true
+
+    name
+        An arbitrary name for this state.
+
+    smb
+        A list of SMB shares (``sharing.smb.create`` parameters).
+        Each needs a ``name``. If unset, SMB shares are not managed.
+
+    nfs
+        A list of NFS shares (``sharing.nfs.create`` parameters).
+        Each needs a ``path`` (SCALE) or ``paths`` (CORE, the first path
+        identifies the share). If unset, NFS shares are not managed.
+
+    prune
+        Delete shares of a managed type that are not in its list.
+        Defaults to false.
+
+    parallel
+        The maximum number of concurrent calls. Defaults to 4.
+
+    reload
+        Reload the sharing service once after changing its shares.
+        Defaults to true.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "All shares are already in the correct state",
+        "changes": {},
+    }
+    try:
+        plans = {}
+        for typ, wanted in (("smb", smb), ("nfs", nfs)):
+            if wanted is None:
+                continue
+            plan = _plan(typ, wanted, prune)
+            if plan["create"] or plan["update"] or plan["delete"]:
+                plans[typ] = plan
+                ret["changes"][typ] = plan["changes"]
+        if not plans:
+            return ret
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = "Would have " + _summary(
+                {typ: plan["changes"] for typ, plan in plans.items()}
+            )
+            return ret
+
+        errors = {}
+        for typ, plan in plans.items():
+            res = __salt__["truenas_share.apply"](
+                typ,
+                create=plan["create"],
+                update=plan["update"],
+                delete=plan["delete"],
+                parallel=parallel,
+            )
+            for ident, err in res["errors"].items():
+                share = plan["keys"].get(ident, ident)
+                errors[f"{typ}:{share}"] = err
+                for action in ("created", "updated", "deleted"):
+                    ret["changes"][typ].get(action, {}).pop(share, None)
+            ret["changes"][typ] = {
+                action: changes
+                for action, changes in ret["changes"][typ].items()
+                if changes
+            }
+            if not ret["changes"][typ]:
+                ret["changes"].pop(typ)
+            elif reload:
+                try:
+                    __salt__["truenas_share.reload"](typ)
+                except CommandExecutionError as err:
+                    errors[f"{typ} service reload"] = str(err)
+        if errors:
+            ret["result"] = False
+            ret["comment"] = "Failed managing some shares:\n" + "\n".join(
+                f"{share}: {err}" for share, err in sorted(errors.items())
+            )
+        else:
+            summary = _summary(ret["changes"])
+            ret["comment"] = summary[:1].upper() + summary[1:]
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
+
+
+def _plan(typ, wanted, prune):
+    if not isinstance(wanted, list):
+        raise SaltInvocationError(f"`{typ}` must be a list of shares")
+    index = {}
+    for share in wanted:
+        share_key = __salt__["truenas_share.key"](typ, share)
+        if not share_key:
+            raise SaltInvocationError(
+                f"Every {typ} share needs a {'name' if typ == 'smb' else 'path'}"
+            )
+        if share_key in index:
+            raise SaltInvocationError(f"Duplicate {typ} share: {share_key}")
+        index[share_key] = share
+    fields = sorted({field for share in wanted for field in share})
+    if typ == "nfs":
+        # Needed to compute the key of existing shares
+        fields = sorted(set(fields).union(["path", "paths"]))
+    curr = {}
+    for share in __salt__["truenas_share.list"](typ, select=["id"] + fields):
+        curr[__salt__["truenas_share.key"](typ, share)] = share
+    plan = {
+        "create": [],
+        "update": {},
+        "delete": [],
+        "keys": {},
+        "changes": {"created": {}, "updated": {}, "deleted": {}},
+    }
+    for share_key, share in index.items():
+        if share_key not in curr:
+            plan["create"].append(share)
+            plan["keys"][share_key] = share_key
+            plan["changes"]["created"][share_key] = share
+            continue
+        changed = {
+            field: val
+            for field, val in share.items()
+            if curr[share_key].get(field) != val
+        }
+        if changed:
+            ident = curr[share_key]["id"]
+            plan["update"][ident] = changed
+            plan["keys"][ident] = share_key
+            plan["changes"]["updated"][share_key] = {
+                field: {"old": curr[share_key].get(field), "new": val}
+                for field, val in changed.items()
+            }
+    if prune:
+        for share_key, share in curr.items():
+            if share_key not in index:
+                plan["delete"].append(share["id"])
+                plan["keys"][share["id"]] = share_key
+                plan["changes"]["deleted"][share_key] = True
+    plan["changes"] = {
+        action: changes for action, changes in plan["changes"].items() if changes
+    }
+    return plan
+
+
+def _summary(changes):
+    parts = []
+    for typ, actions in changes.items():
+        for action in ("created", "updated", "deleted"):
+            if actions.get(action):
+                parts.append(
+                    f"{action} {len(actions[action])} {typ.upper()} share(s)"
+                )
+    return ", ".join(parts)
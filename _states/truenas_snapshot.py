@@ -0,0 +1,100 @@
+"""
+Prune TrueNAS ZFS snapshots according to a retention policy.
+"""
+import logging
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
+
+log = logging.getLogger(__name__)
+
+__virtualname__ = "truenas_snapshot"
+
+
+def __virtual__():
+    try:
+        __salt__["truenas_snapshot.retention"]
+    except KeyError:
+        return False, "`truenas_snapshot` execution module not found"
+    return __virtualname__
+
+
+def pruned(
+    name,
+    keep_last=None,
+    keep_daily=None,
+    recursive=False,
+    name_prefix=None,
+    batch_size=100,
+):
+    """
+    Ensure snapshots of a dataset are pruned according to a retention policy.
+
+    Snapshots are deleted in batches via ``core.bulk``.
+
+    .. code-block:: yaml
+
+        tank/media:
+          truenas_snapshot.pruned:
+            - recursive: true
+            - name_prefix: manual-
+            - keep_last: 10
+            - keep_daily: 14
+
+    name
+        The name of the dataset.
+
+    keep_last
+        Keep the newest N snapshots of each dataset.
+
+    keep_daily
+        For the newest N days with snapshots, keep the newest snapshot
+        of each day (UTC) for each dataset.
+
+    recursive
+        Include snapshots of child datasets. Defaults to false.
+
+    name_prefix
+        Only consider snapshots whose name (the part after ``@``) starts with this.
+        Other snapshots are neither pruned nor counted.
+
+    batch_size
+        The number of snapshots to delete per ``core.bulk`` job.
+        Defaults to 100.
+    """
+    ret = {
+        "name": name,
+        "result": True,
+        "comment": "There are no snapshots to prune",
+        "changes": {},
+    }
+    try:
+        policy = __salt__["truenas_snapshot.retention"](
+            name,
+            keep_last=keep_last,
+            keep_daily=keep_daily,
+            recursive=recursive,
+            name_prefix=name_prefix,
+        )
+        prune = [snap for ds in policy.values() for snap in ds["prune"]]
+        if not prune:
+            return ret
+        ret["changes"]["deleted"] = prune
+        if __opts__["test"]:
+            ret["result"] = None
+            ret["comment"] = f"Would have pruned {len(prune)} snapshot(s)"
+            return ret
+        res = __salt__["truenas_snapshot.delete_many"](prune, batch_size=batch_size)
+        ret["changes"]["deleted"] = res["deleted"]
+        if not res["deleted"]:
+            ret["changes"] = {}
+        ret["comment"] = f"Pruned {len(res['deleted'])} snapshot(s)"
+        if res["errors"]:
+            ret["result"] = False
+            ret["comment"] += f". Failed deleting {len(res['errors'])}:\n" + "\n".join(
+                f"{snap}: {err}" for snap, err in sorted(res["errors"].items())
+            )
+    except (CommandExecutionError, SaltInvocationError) as err:
+        ret["result"] = False
+        ret["comment"] = str(err)
+        ret["changes"] = {}
+    return ret
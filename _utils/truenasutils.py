@@ -1,4 +1,18 @@
-from salt.exceptions import CommandExecutionError
+import base64
+import concurrent.futures
+import contextlib
+import copy
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from salt.exceptions import CommandExecutionError, SaltInvocationError
 
 try:
     import middlewared.client
@@ -8,14 +22,42 @@ try:
 except ImportError:
     HAS_PYTHON_CLIENT = False
 
+log = logging.getLogger(__name__)
+
 CKEY = "_truenas_client"
+SNAPSHOT_CKEY = "_truenas_snapshot"
+METHODS_CKEY = "_truenas_methods"
+MIRROR_CKEY = "_truenas_mirror"
+LIMITER_CKEY = "_truenas_limiter"
+
+# Namespaces mirrored by default when the mirror is enabled
+MIRROR_NAMESPACES = ("certificate", "service", "ssh", "system.general")
+# Methods of mirrored namespaces that change state
+MIRROR_WRITE_METHODS = (
+    "create",
+    "update",
+    "delete",
+    "start",
+    "stop",
+    "restart",
+    "reload",
+)
+
+SNAPSHOT_VERSION = 2
+# Changes whenever the configuration is written
+CONFIG_DB = "/data/freenas-v1.db"
+# Results that cannot be used to answer read calls: they are only stored
+# partially (secrets are stripped) or contain runtime state that is not
+# kept in the configuration database, so the change marker misses it
+SNAPSHOT_PARTIAL = ("certificate.query", "ssh.config", "jail.query", "service.query")
 
 
 class TrueNASMiddlewaredClient:
-    def __init__(self, client=None):
+    def __init__(self, client=None, limiter=None):
         if client is None:
             client = middlewared.client.Client()
         self.client = client
+        self.limiter = limiter
 
     def call(self, func, *args, timeout=None):
         """
@@ -25,7 +67,8 @@ class TrueNASMiddlewaredClient:
 
     def job(self, func, *args, timeout=None, callback=None):
         """
-        Some API calls are jobs.
+        Some API calls are jobs. ``timeout`` limits the time to wait
+        for the job to finish, after which it is aborted.
         """
         kwargs = {
             "job": True,
@@ -33,10 +76,108 @@ class TrueNASMiddlewaredClient:
         }
         return self._call(func, args, timeout=timeout, **kwargs)
 
+    def bulk(self, func, params, batch_size=None, timeout=None, callback=None):
+        """
+        Run a method for many argument lists via ``core.bulk``, which
+        executes them as a single job instead of one round trip per item.
+
+        Returns a list of dicts with ``result`` and ``error`` in the order
+        of ``params``. Parameters that are not lists are passed as
+        the single argument. Optionally splits ``params`` into batches
+        of ``batch_size``, which are run one after another: the middleware
+        locks ``core.bulk`` jobs per method, so they would not run
+        concurrently anyways. ``callback`` receives job progress updates.
+        """
+        params = [list(p) if isinstance(p, (list, tuple)) else [p] for p in params]
+        size = batch_size or len(params) or 1
+        ret = []
+        for i in range(0, len(params), size):
+            batch = params[i : i + size]
+            try:
+                res = self.job(
+                    "core.bulk", func, batch, timeout=timeout, callback=callback
+                )
+            except Exception as err:  # pylint: disable=broad-except
+                ret.extend({"result": None, "error": str(err)} for _ in batch)
+                continue
+            ret.extend(
+                {"result": status.get("result"), "error": status.get("error")}
+                for status in res
+            )
+        return ret
+
+    def subscribe(self, name, callback):
+        """
+        Subscribe to a middleware event. ``callback(mtype, **message)``
+        is called from the client thread for each event.
+        Returns an identifier that can be passed to ``unsubscribe``.
+        """
+        return self.client.subscribe(name, callback)
+
+    def unsubscribe(self, ident):
+        """
+        Cancel an event subscription.
+        """
+        self.client.unsubscribe(ident)
+
+    def close(self):
+        """
+        Close the connection. Only needed for long-lived clients
+        that are not used as a context manager.
+        """
+        self.client.close()
+
+    @property
+    def closed(self):
+        """
+        Whether the underlying connection has been closed.
+        """
+        closed = getattr(self.client, "_closed", None)
+        return closed is not None and closed.is_set()
+
     def _call(self, func, args, timeout=None, **kwargs):
         if timeout is not None:
             kwargs["timeout"] = timeout
-        return self.client.call(func, *args, **kwargs)
+        if self.limiter is None and (timeout is None or not kwargs.get("job")):
+            return self.client.call(func, *args, **kwargs)
+        if not kwargs.get("job"):
+            with self.limiter.slot():
+                return self.client.call(func, *args, **kwargs)
+        # Only submitting a job holds a slot, waiting for it does not load
+        # the middleware. This returns the job instead of its result.
+        kwargs["job"] = "RETURN"
+        slot = self.limiter.slot() if self.limiter else contextlib.nullcontext()
+        with slot:
+            job = self.client.call(func, *args, **kwargs)
+        if timeout is None:
+            return job.result()
+        return self._wait_job(func, job, timeout)
+
+    def _wait_job(self, func, job, timeout):
+        # The client only passes the timeout to the submission,
+        # waiting for the result blocks until the job has finished
+        res = {}
+
+        def wait():
+            try:
+                res["result"] = job.result()
+            except Exception as err:  # pylint: disable=broad-except
+                res["error"] = err
+
+        waiter = threading.Thread(target=wait, daemon=True)
+        waiter.start()
+        waiter.join(timeout)
+        if waiter.is_alive():
+            try:
+                self.client.call("core.job_abort", job.job_id)
+            except Exception as err:  # pylint: disable=broad-except
+                log.warning(f"Could not abort {func} job {job.job_id}: {err}")
+            raise CommandExecutionError(
+                f"Timed out after {timeout}s waiting for {func} to finish"
+            )
+        if "error" in res:
+            raise res["error"]
+        return res["result"]
 
     def __enter__(self):
         self.client.__enter__()
@@ -47,6 +188,231 @@ class TrueNASMiddlewaredClient:
         return
 
 
+class TrueNASMirroredClient:
+    """
+    Wraps a long-lived client and keeps an in-memory mirror of
+    ``<namespace>.config`` and ``<namespace>.query`` results
+    for the configured namespaces.
+
+    The mirror subscribes to the corresponding change events and
+    patches its copy in place, so once it is warm, reads do not cause
+    any middleware traffic. Query filters and options are evaluated
+    locally. Writes through this client (``MIRROR_WRITE_METHODS`` and jobs)
+    invalidate the namespace, ``max_age`` bounds staleness in case events
+    are not emitted.
+    """
+
+    def __init__(self, client, namespaces=MIRROR_NAMESPACES, max_age=300):
+        self.client = client
+        self.namespaces = set(namespaces)
+        self.max_age = max_age
+        self._cache = {}
+        self._subscribed = set()
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, timeout=None):
+        """
+        Call a TrueNAS middleware service, serving reads from the mirror.
+        """
+        ns, _, method = func.rpartition(".")
+        if ns not in self.namespaces:
+            return self.client.call(func, *args, timeout=timeout)
+        if method == "config" and not args:
+            return self._read(func, timeout)
+        if method == "query" and len(args) <= 2:
+            filters = args[0] if args else []
+            options = args[1] if len(args) > 1 else {}
+            # Extra options can change the contents of the result
+            if not options.get("extra"):
+                return filter_list(self._read(func, timeout), filters, options)
+        if method in MIRROR_WRITE_METHODS:
+            self.invalidate(ns)
+        return self.client.call(func, *args, timeout=timeout)
+
+    def job(self, func, *args, timeout=None, callback=None):
+        """
+        Some API calls are jobs. These are never served from the mirror.
+        """
+        self.invalidate(func.rpartition(".")[0])
+        return self.client.job(func, *args, timeout=timeout, callback=callback)
+
+    def bulk(self, func, params, **kwargs):
+        """
+        Run a method for many argument lists via ``core.bulk``.
+        """
+        self.invalidate(func.rpartition(".")[0])
+        return self.client.bulk(func, params, **kwargs)
+
+    def subscribe(self, name, callback):
+        return self.client.subscribe(name, callback)
+
+    def unsubscribe(self, ident):
+        self.client.unsubscribe(ident)
+
+    def invalidate(self, ns=None):
+        """
+        Drop mirrored results of a namespace or all of them.
+        """
+        with self._lock:
+            for func in list(self._cache):
+                if ns is None or func.rpartition(".")[0] == ns:
+                    self._cache.pop(func)
+
+    def close(self):
+        self.client.close()
+
+    @property
+    def closed(self):
+        return self.client.closed
+
+    def _read(self, func, timeout):
+        with self._lock:
+            cached = self._cache.get(func)
+            if cached is not None and time.time() - cached[1] < self.max_age:
+                return copy.deepcopy(cached[0])
+        if func not in self._subscribed:
+            self.client.subscribe(func, self._callback(func))
+            self._subscribed.add(func)
+        if func.endswith(".query"):
+            res = self.client.call(func, [], {"limit": 0}, timeout=timeout)
+        else:
+            res = self.client.call(func, timeout=timeout)
+        with self._lock:
+            self._cache[func] = (res, time.time())
+            return copy.deepcopy(res)
+
+    def _callback(self, func):
+        def callback(mtype, **message):  # pylint: disable=unused-argument
+            with self._lock:
+                if func in self._cache:
+                    self._apply(func, message)
+
+        return callback
+
+    def _apply(self, func, message):
+        data, ts = self._cache[func]
+        msg = (message.get("msg") or "").lower()
+        fields = message.get("fields") or {}
+        if func.endswith(".config"):
+            if msg == "changed" and fields:
+                data.update(fields)
+            else:
+                self._cache.pop(func)
+            return
+        ident = message.get("id", fields.get("id"))
+        if msg == "added":
+            data.append(fields)
+        elif msg == "removed":
+            data[:] = [item for item in data if item.get("id") != ident]
+        elif msg == "changed":
+            for item in data:
+                if item.get("id") == ident:
+                    item.update(fields)
+                    for cleared in message.get("cleared_fields") or []:
+                        item.pop(cleared, None)
+                    break
+            else:
+                self._cache.pop(func)
+                return
+        else:
+            self._cache.pop(func)
+            return
+        self._cache[func] = (data, ts)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        # The connection is kept open for subsequent reads
+        return
+
+
+class TrueNASSnapshotClient:
+    """
+    Answers ``<namespace>.config`` and ``<namespace>.query`` reads
+    from a local configuration snapshot (see ``take_snapshot``).
+    Everything else is sent to a live client, which is only
+    connected when needed.
+
+    Each result in the snapshot records the change marker it was read at.
+    When the configuration changed since, only the requested result is
+    read again and updated in the snapshot, which is then written back
+    via ``save`` when the client is closed.
+    """
+
+    def __init__(self, snapshot, factory=None, save=None):
+        self.snapshot = snapshot
+        self._factory = factory or TrueNASMiddlewaredClient
+        self._save = save
+        self._dirty = False
+        self._live = None
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, timeout=None):
+        """
+        Call a TrueNAS middleware service, serving reads from the snapshot.
+        """
+        if func in self.snapshot["data"] and func not in SNAPSHOT_PARTIAL:
+            if func.endswith(".config") and not args:
+                return copy.deepcopy(self._read(func, timeout))
+            if func.endswith(".query") and len(args) <= 2:
+                options = args[1] if len(args) > 1 else {}
+                if not options.get("extra"):
+                    filters = args[0] if args else []
+                    return copy.deepcopy(
+                        filter_list(self._read(func, timeout), filters, options)
+                    )
+        return self.live.call(func, *args, timeout=timeout)
+
+    def job(self, func, *args, timeout=None, callback=None):
+        """
+        Some API calls are jobs. These are never served from the snapshot.
+        """
+        return self.live.job(func, *args, timeout=timeout, callback=callback)
+
+    def bulk(self, func, params, **kwargs):
+        """
+        Run a method for many argument lists via ``core.bulk``.
+        """
+        return self.live.bulk(func, params, **kwargs)
+
+    @property
+    def live(self):
+        with self._lock:
+            if self._live is None:
+                if not HAS_PYTHON_CLIENT:
+                    raise CommandExecutionError("Could not load TrueNAS client")
+                self._live = self._factory().__enter__()
+            return self._live
+
+    def _read(self, func, timeout):
+        marker = change_marker()
+        if self.snapshot["markers"].get(func) == marker:
+            return self.snapshot["data"][func]
+        log.debug(f"TrueNAS configuration changed, refreshing {func} in the snapshot")
+        if func.endswith(".query"):
+            res = self.live.call(func, [], {"limit": 0}, timeout=timeout)
+        else:
+            res = self.live.call(func, timeout=timeout)
+        res = _snapshot_result(func, res)
+        with self._lock:
+            self.snapshot["data"][func] = res
+            self.snapshot["markers"][func] = marker
+            self._dirty = True
+        return res
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if self._dirty and self._save is not None:
+            self._save(self.snapshot)
+            self._dirty = False
+        if self._live is not None:
+            self._live.__exit__(typ, value, traceback)
+            self._live = None
+
+
 # More clients could be added - midclt or REST
 
 
@@ -61,10 +427,696 @@ def get_client(opts, context):
     # would need to do something like in the InfluxDB returner
     # if CKEY in context:
     #     return context[CKEY]
+    reads = opts.get("truenas_snapshot_reads")
+    if reads is True or (reads == "test" and opts.get("test")):
+        snapshot = get_snapshot(opts, context)
+        if snapshot is not None:
+            return TrueNASSnapshotClient(
+                snapshot,
+                factory=lambda: get_local_client(opts, context),
+                save=lambda snap: save_snapshot(opts, snap),
+            )
+    if opts.get("truenas_mirror"):
+        return get_mirror(opts, context)
     client = None
     if HAS_PYTHON_CLIENT:
-        client = TrueNASMiddlewaredClient()
+        client = get_local_client(opts, context)
     if client is not None:
         # context[CKEY] = client
         return client
     raise CommandExecutionError("Could not load TrueNAS client")
+
+
+def get_local_client(opts, context):
+    """
+    Return a plain client for the local middleware, subject to the
+    host-wide call limit (see ``get_limiter``).
+    """
+    if not HAS_PYTHON_CLIENT:
+        raise CommandExecutionError("Could not load TrueNAS client")
+    return TrueNASMiddlewaredClient(limiter=get_limiter(opts, context))
+
+
+def get_limiter(opts, context):
+    """
+    Return the limiter for concurrent calls to the local middleware,
+    kept in ``context``. Returns None unless ``truenas_max_concurrent_calls``
+    is set in the minion configuration.
+
+    The limit applies to all processes on the host, e.g. scheduled
+    highstates, reactions and manual runs. Submitting a job takes a slot,
+    waiting for its result does not. ``truenas_max_concurrent_wait``
+    optionally sets the time in seconds to wait for a free slot
+    before failing. Waiters are not served in arrival order then.
+    """
+    limit = opts.get("truenas_max_concurrent_calls")
+    if not limit:
+        return None
+    limiter = context.get(LIMITER_CKEY)
+    if limiter is None or limiter.limit != int(limit):
+        limiter = CallLimiter(
+            os.path.join(opts["cachedir"], "truenas", "limiter"),
+            int(limit),
+            timeout=opts.get("truenas_max_concurrent_wait"),
+        )
+        context[LIMITER_CKEY] = limiter
+    return limiter
+
+
+class CallLimiter:
+    """
+    A counting semaphore shared by all processes on the host, built
+    on ``flock`` so that slots held by crashed processes are released
+    by the kernel.
+
+    Each slot is a lock file. Waiters first queue on a turnstile lock,
+    so only the head of the queue polls for a free slot and slots are
+    handed out roughly in arrival order instead of to whoever polls
+    at the right moment. With a ``timeout``, the turnstile is polled
+    as well since ``flock`` cannot wait with a timeout, so there is
+    no arrival ordering then.
+
+    Time spent waiting is tracked per process in ``stats`` and,
+    for calls that had to wait, host-wide in ``stats.json``.
+    """
+
+    POLL_INTERVAL = 0.02
+
+    def __init__(self, path, limit, timeout=None):
+        self.path = path
+        self.limit = limit
+        self.timeout = timeout
+        self.stats = {"calls": 0, "waited": 0, "wait_total": 0.0, "wait_max": 0.0}
+        self._lock = threading.Lock()
+        os.makedirs(path, mode=0o700, exist_ok=True)
+
+    @contextlib.contextmanager
+    def slot(self):
+        """
+        Hold one of the slots while the block executes.
+        """
+        start = time.monotonic()
+        fd = self._acquire(start)
+        waited = time.monotonic() - start
+        self._record(waited)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _acquire(self, start):
+        turnstile = self._open("turnstile")
+        try:
+            self._lock_file(turnstile, start)
+            while True:
+                for i in range(self.limit):
+                    fd = self._open(f"slot-{i}")
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        os.close(fd)
+                        continue
+                    return fd
+                self._check_timeout(start)
+                time.sleep(self.POLL_INTERVAL)
+        finally:
+            # Closing releases the turnstile for the next waiter
+            os.close(turnstile)
+
+    def _lock_file(self, fd, start):
+        if self.timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            return
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                self._check_timeout(start)
+                time.sleep(self.POLL_INTERVAL)
+
+    def _check_timeout(self, start):
+        if self.timeout is not None and time.monotonic() - start >= self.timeout:
+            raise CommandExecutionError(
+                f"Timed out after {self.timeout}s waiting for one of "
+                f"{self.limit} TrueNAS middleware call slots"
+            )
+
+    def _open(self, name):
+        return os.open(os.path.join(self.path, name), os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _record(self, waited):
+        with self._lock:
+            self.stats["calls"] += 1
+            # Acquiring free locks takes far less than a poll interval
+            if waited < self.POLL_INTERVAL:
+                return
+            self.stats["waited"] += 1
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        log.debug(f"Waited {waited:.3f}s for a TrueNAS middleware call slot")
+        try:
+            self._record_shared(waited)
+        except OSError as err:
+            log.warning(f"Could not record TrueNAS call limiter stats: {err}")
+
+    def _record_shared(self, waited):
+        fd = self._open("stats.lock")
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stats = load_limiter_stats(self.path)
+            stats["waited"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            stats["last_wait"] = waited
+            stats["last_wait_at"] = time.time()
+            write_cache(os.path.join(self.path, "stats.json"), stats)
+        finally:
+            os.close(fd)
+
+
+def load_limiter_stats(path):
+    """
+    Return the host-wide wait statistics of the call limiter
+    in the directory ``path``.
+    """
+    stats = {
+        "waited": 0,
+        "wait_total": 0.0,
+        "wait_max": 0.0,
+        "last_wait": None,
+        "last_wait_at": None,
+    }
+    try:
+        with open(os.path.join(path, "stats.json")) as f:
+            stats.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except ValueError as err:
+        log.warning(f"Ignoring invalid TrueNAS call limiter stats: {err}")
+    return stats
+
+
+def get_remote_client(
+    uri, api_key=None, username=None, password=None, verify_ssl=True, timeout=None
+):
+    """
+    Return an authenticated client for a remote TrueNAS system.
+
+    uri
+        The websocket endpoint, e.g. ``wss://nas.example.com/websocket``.
+
+    api_key
+        An API key to authenticate with. Either this or
+        ``username``/``password`` is required.
+
+    verify_ssl
+        Verify the TLS certificate. Defaults to true.
+
+    timeout
+        The default timeout for calls in seconds.
+    """
+    if not HAS_PYTHON_CLIENT:
+        raise CommandExecutionError("Could not load TrueNAS client")
+    kwargs = {"uri": uri}
+    if not verify_ssl:
+        kwargs["verify_ssl"] = False
+    if timeout is not None:
+        kwargs["call_timeout"] = timeout
+    client = TrueNASMiddlewaredClient(middlewared.client.Client(**kwargs))
+    try:
+        if api_key:
+            authenticated = client.call("auth.login_with_api_key", api_key)
+        elif username:
+            authenticated = client.call("auth.login", username, password)
+        else:
+            raise SaltInvocationError("Either api_key or username is required")
+        if not authenticated:
+            raise CommandExecutionError(f"Authentication failed for {uri}")
+    except Exception:
+        client.close()
+        raise
+    return client
+
+
+def get_mirror(opts, context):
+    """
+    Return a long-lived client that mirrors frequently read
+    configuration locally, kept in ``context``.
+
+    Enable it for all modules by setting ``truenas_mirror`` in the
+    minion configuration, either to true or to a list of namespaces.
+    This is most useful in long-lived processes.
+    """
+    mirror = context.get(MIRROR_CKEY)
+    if mirror is not None and not mirror.closed:
+        return mirror
+    namespaces = opts.get("truenas_mirror")
+    if not isinstance(namespaces, (list, tuple)):
+        namespaces = MIRROR_NAMESPACES
+    mirror = TrueNASMirroredClient(
+        get_local_client(opts, context),
+        namespaces=namespaces,
+        max_age=opts.get("truenas_mirror_max_age", 300),
+    )
+    context[MIRROR_CKEY] = mirror
+    return mirror
+
+
+def write_cache(path, data):
+    """
+    Atomically write JSON data to a cache file only readable by the owner.
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def snapshot_path(opts):
+    """
+    Return the path of the local configuration snapshot.
+    """
+    return os.path.join(opts["cachedir"], "truenas", "snapshot.json")
+
+
+def change_marker():
+    """
+    Return a cheap marker that changes when the configuration changes.
+    """
+    try:
+        return os.stat(CONFIG_DB).st_mtime
+    except OSError:
+        return None
+
+
+def take_snapshot(client, calls, parallel=8):
+    """
+    Run a list of read calls (``<namespace>.config``/``<namespace>.query``)
+    concurrently over one connection and return a snapshot of the results.
+
+    Secrets are not stored: certificates are reduced to their metadata
+    and a SHA-256 fingerprint, SSH host keys are dropped.
+    """
+    marker = change_marker()
+
+    def read(func):
+        if func.endswith(".query"):
+            return client.call(func, [], {"limit": 0})
+        return client.call(func)
+
+    res = run_concurrently(
+        read, ((func, (func,)) for func in calls), parallel=parallel
+    )
+    data = {
+        func: _snapshot_result(func, result)
+        for func, result in res["results"].items()
+    }
+    return {
+        "version": SNAPSHOT_VERSION,
+        "created": time.time(),
+        "calls": list(calls),
+        "data": data,
+        "markers": dict.fromkeys(data, marker),
+        "errors": res["errors"],
+    }
+
+
+def _snapshot_result(func, result):
+    if func == "certificate.query":
+        return [_strip_certificate(cert) for cert in result]
+    if func == "ssh.config":
+        return {
+            conf: val
+            for conf, val in result.items()
+            if not (conf.startswith("host_") and conf.endswith("_key"))
+        }
+    return result
+
+
+def save_snapshot(opts, snapshot):
+    """
+    Write a snapshot to the cache atomically.
+    """
+    path = snapshot_path(opts)
+    write_cache(path, snapshot)
+    return path
+
+
+def load_snapshot(opts):
+    """
+    Load the cached snapshot. Returns None if it is missing,
+    unreadable or was written by an incompatible version.
+    """
+    try:
+        with open(snapshot_path(opts)) as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+def get_snapshot(opts, context):
+    """
+    Return the configuration snapshot. Returns None if no snapshot
+    has been taken yet (see ``truenas.snapshot``) or changes cannot
+    be detected, in which case live calls should be used.
+
+    Results that are outdated are refreshed individually when they are
+    read (see ``TrueNASSnapshotClient``).
+    """
+    if change_marker() is None:
+        log.debug("Cannot detect TrueNAS configuration changes, using live calls")
+        return None
+    snapshot = context.get(SNAPSHOT_CKEY)
+    if snapshot is None:
+        snapshot = load_snapshot(opts)
+        if snapshot is None:
+            log.debug("No TrueNAS configuration snapshot found, using live calls")
+            return None
+        context[SNAPSHOT_CKEY] = snapshot
+    return snapshot
+
+
+def _versioned_path(opts, name, version):
+    return os.path.join(
+        opts["cachedir"],
+        "truenas",
+        "{}-{}.json".format(name, re.sub(r"[^\w.-]", "_", version)),
+    )
+
+
+def load_versioned(opts, name, version):
+    """
+    Load data that only changes between TrueNAS versions from the cache.
+    Returns None if it is missing or ``version`` is unknown.
+    """
+    if not version:
+        return None
+    try:
+        with open(_versioned_path(opts, name, version)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store_versioned(opts, name, version, data):
+    """
+    Cache data that only changes between TrueNAS versions.
+    Does nothing if ``version`` is unknown.
+    """
+    if not version:
+        return
+    write_cache(_versioned_path(opts, name, version), data)
+
+
+def get_methods(opts, context, version=None):
+    """
+    Return the accepted parameter schemas of all API methods
+    (from ``core.get_methods``).
+
+    These are fetched once per TrueNAS version and cached on disk.
+    If ``version`` is unknown, they are only cached in ``context``.
+    """
+    cached = context.get(METHODS_CKEY)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    methods = load_versioned(opts, "methods", version)
+    if methods is None:
+        with get_client(opts, context) as client:
+            res = client.call("core.get_methods")
+        methods = {name: method.get("accepts") for name, method in res.items()}
+        store_versioned(opts, "methods", version, methods)
+    context[METHODS_CKEY] = (version, methods)
+    return methods
+
+
+def validate_payload(methods, func, args):
+    """
+    Validate positional arguments for an API method against its schema
+    before sending them. Raises ``SaltInvocationError`` listing all problems.
+
+    Schemas that are not understood are not validated.
+    """
+    if func not in methods:
+        raise SaltInvocationError(f"Unknown API method '{func}'")
+    accepts = methods[func]
+    if isinstance(accepts, dict):
+        accepts = accepts.get("prefixItems") or accepts.get("items")
+    if not isinstance(accepts, list):
+        return True
+    errors = []
+    for schema, arg in zip(accepts, args):
+        if isinstance(schema, dict):
+            path = "" if isinstance(arg, dict) else schema.get("_name_") or ""
+            _validate_schema(schema, arg, path, errors)
+    if errors:
+        raise SaltInvocationError(
+            f"Invalid parameters for '{func}':\n" + "\n".join(errors)
+        )
+    return True
+
+
+JSON_TYPES = {
+    "array": lambda x: isinstance(x, list),
+    "boolean": lambda x: isinstance(x, bool),
+    "integer": lambda x: isinstance(x, int) and not isinstance(x, bool),
+    "null": lambda x: x is None,
+    "number": lambda x: isinstance(x, (int, float)) and not isinstance(x, bool),
+    "object": lambda x: isinstance(x, dict),
+    "string": lambda x: isinstance(x, str),
+}
+
+
+def _validate_schema(schema, value, path, errors):
+    for key in ("anyOf", "oneOf"):
+        if schema.get(key):
+            for sub in schema[key]:
+                sub_errors = []
+                _validate_schema(sub, value, path, sub_errors)
+                if not sub_errors:
+                    return
+            errors.append(f"'{path}': {value!r} does not match any allowed schema")
+            return
+    types = schema.get("type")
+    if isinstance(types, str):
+        types = [types]
+    if types and all(typ in JSON_TYPES for typ in types):
+        if not any(JSON_TYPES[typ](value) for typ in types):
+            errors.append(
+                f"'{path}' must be of type {' or '.join(types)}, "
+                f"got {type(value).__name__}"
+            )
+            return
+    if schema.get("enum") and value not in schema["enum"]:
+        errors.append(
+            f"'{path}' must be one of {', '.join(repr(x) for x in schema['enum'])}, "
+            f"got {value!r}"
+        )
+        return
+    if isinstance(value, dict) and "properties" in schema:
+        props = schema["properties"]
+        for key, val in value.items():
+            sub_path = f"{path}.{key}" if path else key
+            if key in props:
+                _validate_schema(props[key], val, sub_path, errors)
+            elif schema.get("additionalProperties") is False:
+                errors.append(
+                    f"Unknown parameter '{sub_path}'. "
+                    f"Available: {', '.join(sorted(props))}"
+                )
+    elif isinstance(value, list) and isinstance(schema.get("items"), dict):
+        for i, val in enumerate(value):
+            _validate_schema(schema["items"], val, f"{path}[{i}]", errors)
+
+
+def pem_fingerprint(pem):
+    """
+    Return the SHA-256 fingerprint of the DER-encoded certificate(s)
+    in a PEM string. Chains are fingerprinted as a whole.
+    """
+    blocks = re.findall(
+        r"-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----", pem, re.DOTALL
+    )
+    if not blocks:
+        return hashlib.sha256(pem.strip().encode()).hexdigest()
+    der = b"".join(base64.b64decode("".join(block.split())) for block in blocks)
+    return hashlib.sha256(der).hexdigest()
+
+
+def _strip_certificate(cert):
+    ret = {
+        key: val
+        for key, val in cert.items()
+        if key not in ("certificate", "privatekey", "CSR", "chain_list")
+    }
+    if cert.get("certificate"):
+        ret["fingerprint_sha256"] = pem_fingerprint(cert["certificate"])
+    return ret
+
+
+def compact_properties(record, field="value"):
+    """
+    Reduce the ZFS property dicts of a query result to a single field.
+
+    ZFS properties are returned as dicts containing ``value``, ``rawvalue``,
+    ``parsed`` and ``source``, which makes results for large pools huge.
+    Nested records (like snapshot ``properties``) are compacted as well.
+    """
+    ret = {}
+    for key, val in record.items():
+        if isinstance(val, dict):
+            if "rawvalue" in val and "source" in val:
+                ret[key] = val.get(field)
+                continue
+            val = compact_properties(val, field=field)
+        ret[key] = val
+    return ret
+
+
+def run_concurrently(func, items, parallel=4, max_failures=None, callback=None):
+    """
+    Run ``func(*args)`` for each ``(key, args)`` pair in ``items``
+    with at most ``parallel`` calls in flight.
+
+    The middlewared client multiplexes calls over a single connection,
+    so a single client can be shared between the workers.
+
+    Returns a dict with ``results`` and ``errors`` (both mapping keys
+    to return values/error messages) and ``skipped``, a list of keys
+    that were not run because ``max_failures`` errors were reached.
+    ``callback(key, result, error)`` is called as soon as each item finishes.
+    """
+    ret = {"results": {}, "errors": {}, "skipped": []}
+    pending = iter(items)
+    running = {}
+
+    def failed():
+        return max_failures is not None and len(ret["errors"]) >= max_failures
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as pool:
+        while True:
+            while len(running) < max(1, parallel) and not failed():
+                try:
+                    key, args = next(pending)
+                except StopIteration:
+                    break
+                running[pool.submit(func, *args)] = key
+            if not running:
+                break
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                key = running.pop(future)
+                result = error = None
+                try:
+                    result = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    error = str(err)
+                    ret["errors"][key] = error
+                else:
+                    ret["results"][key] = result
+                if callback is not None:
+                    callback(key, result, error)
+    ret["skipped"] = [key for key, _ in pending]
+    return ret
+
+
+FILTER_OPS = {
+    "=": lambda x, y: x == y,
+    "!=": lambda x, y: x != y,
+    ">": lambda x, y: x is not None and x > y,
+    ">=": lambda x, y: x is not None and x >= y,
+    "<": lambda x, y: x is not None and x < y,
+    "<=": lambda x, y: x is not None and x <= y,
+    "~": lambda x, y: x is not None and re.match(y, x) is not None,
+    "in": lambda x, y: x in y,
+    "nin": lambda x, y: x not in y,
+    "rin": lambda x, y: x is not None and y in x,
+    "rnin": lambda x, y: x is not None and y not in x,
+    "^": lambda x, y: x is not None and x.startswith(y),
+    "!^": lambda x, y: x is not None and not x.startswith(y),
+    "$": lambda x, y: x is not None and x.endswith(y),
+    "!$": lambda x, y: x is not None and not x.endswith(y),
+}
+
+
+def filter_list(data, filters=None, options=None):
+    """
+    Evaluate middleware query filters and options locally.
+
+    Supports the common filter operators, ``OR`` conjunctions, dotted
+    field names and the ``order_by``, ``select``, ``offset``, ``limit``,
+    ``count`` and ``get`` options.
+    """
+    options = options or {}
+    res = [item for item in data if _matches_filters(item, filters or [])]
+    for field in reversed(options.get("order_by") or []):
+        reverse = field.startswith("-")
+        field = field.lstrip("-")
+        field = field.split(":", 1)[-1]
+        res.sort(
+            key=lambda x: (_get_field(x, field) is None, _get_field(x, field)),
+            reverse=reverse,
+        )
+    if options.get("offset"):
+        res = res[options["offset"] :]
+    if options.get("limit"):
+        res = res[: options["limit"]]
+    if options.get("select"):
+        res = [_select_fields(item, options["select"]) for item in res]
+    if options.get("count"):
+        return len(res)
+    if options.get("get"):
+        if not res:
+            raise CommandExecutionError("Object does not exist")
+        return res[0]
+    return res
+
+
+def _matches_filters(item, filters):
+    for fltr in filters:
+        if len(fltr) == 2 and fltr[0] == "OR":
+            if not any(
+                _matches_filters(item, sub if isinstance(sub[0], list) else [sub])
+                for sub in fltr[1]
+            ):
+                return False
+            continue
+        field, op, val = fltr
+        if op not in FILTER_OPS:
+            raise CommandExecutionError(f"Unsupported filter operator: {op}")
+        try:
+            if not FILTER_OPS[op](_get_field(item, field), val):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def _select_fields(item, fields):
+    ret = {}
+    for field in fields:
+        *parents, last = field.split(".")
+        dst = ret
+        for part in parents:
+            dst = dst.setdefault(part, {})
+        dst[last] = _get_field(item, field)
+    return ret
+
+
+def _get_field(item, field):
+    for part in field.split("."):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(part)
+    return item